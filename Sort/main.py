@@ -1,15 +1,24 @@
 import argparse
+import contextlib
+import cProfile
+import functools
+import os
 import sys
 import tempfile
 import time
 
 from out_sort import out_sort, sort_statistic
 
+# Seconds between progress lines; changes of state are always shown.
+PROGRESS_INTERVAL = 0.2
+
 
 def main(argv):
     try:
-        with open(argv.input_filename, "r"), open(argv.output_filename, "w"):
-            pass
+        if argv.input_filename != out_sort.STREAM:
+            open(argv.input_filename, "r").close()
+        if argv.output_filename != out_sort.STREAM:
+            open(argv.output_filename, "w").close()
     except FileNotFoundError:
         print("There is no such file.", file=sys.stderr)
         sys.exit(1)
@@ -20,34 +29,85 @@ def main(argv):
         print("Something wrong.", file=sys.stderr)
         sys.exit(3)
     try:
-        stat = sort_statistic.Statistic(classic_stat_printer)
-        with tempfile.TemporaryDirectory() as tempdir:
-            out_sort.out_sort(argv.input_filename, argv.output_filename, tempdir,
+        stat = sort_statistic.Statistic(functools.partial(classic_stat_printer, file=get_info_file(argv)),
+                                        interval=PROGRESS_INTERVAL)
+        with get_workdir(argv) as workdir, get_profiler(argv):
+            out_sort.out_sort(argv.input_filename, argv.output_filename, workdir,
                               reverse_order=argv.reverse_order, sep=argv.sep,
                               field=argv.field, types=argv.types, memory_usage=argv.memory,
-                              statistic=stat)
+                              statistic=stat, processes=argv.processes,
+                              run_formation=argv.run_formation, encoding=argv.encoding,
+                              use_mmap=argv.use_mmap, compression=argv.compression, key_specs=argv.key_specs,
+                              unique=argv.unique, count=argv.count, head=argv.head,
+                              resume=argv.workdir is not None, profile=argv.profile)
     except ValueError as err:
         print(err, file=sys.stderr)
         sys.exit(4)
+    if argv.metrics is not None:
+        with open(argv.metrics, "w") as f:
+            f.write(stat.to_prometheus() if argv.metrics_format == "prometheus" else stat.to_json())
+
+
+@contextlib.contextmanager
+def get_workdir(argv):
+    # A given work directory is kept, so an interrupted sort started with the same arguments resumes there.
+    if argv.workdir is None:
+        with tempfile.TemporaryDirectory() as tempdir:
+            yield tempdir
+        return
+    os.makedirs(argv.workdir, exist_ok=True)
+    yield argv.workdir
+
 
+@contextlib.contextmanager
+def get_profiler(argv):
+    # The main process is profiled to main.prof, workers of the pool to worker-<N>.prof in the same directory.
+    if argv.profile is None:
+        yield
+        return
+    os.makedirs(argv.profile, exist_ok=True)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(argv.profile, "main.prof"))
+
+
+def get_info_file(argv):
+    # Sorted data goes to stdout when the output is "-", so progress has to go elsewhere.
+    return sys.stderr if argv.output_filename == out_sort.STREAM else sys.stdout
 
-def classic_stat_printer(stat):
-    part = stat.get_finished_part() * 100
-    cur_str = ["."] * 50
-    for i in range(2, 101, 2):
-        if part >= i:
-            cur_str[i // 2 - 1] = '#'
-    print("\r[{0}] {1} - {2:.2f}%".format(''.join(cur_str), stat.state.name, part), end="")
+
+def classic_stat_printer(stat, file=sys.stdout):
     if stat.state == sort_statistic.State.FINISHED:
-        print("\rREADY")
+        print("\rREADY", file=file)
+        return
+    speed = stat.throughput / 2 ** 20
+    if stat.expected_size is None:
+        print("\r{0} - {1} bytes, {2:.1f} MB/s".format(stat.state.name, stat.printed_size, speed), end="", file=file)
+        return
+    part = stat.get_finished_part()
+    done = int(part * 50)
+    print("\r[{0}{1}] {2} - {3:.2f}%, {4:.1f} MB/s, ETA {5}   ".format("#" * done, "." * (50 - done), stat.state.name,
+                                                                    part * 100, speed, format_eta(stat.eta)),
+          end="", file=file)
+
+
+def format_eta(eta):
+    if eta is None:
+        return "?"
+    minutes, seconds = divmod(int(eta), 60)
+    return "{0}:{1:02d}".format(minutes, seconds)
 
 
 def read_args(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument("input_filename", type=str,
-                        help="Name of target file.")
+                        help="Name of target file, - for stdin.")
     parser.add_argument("output_filename", type=str,
-                        help="Name of file for result.")
+                        help="Name of file for result, - for stdout.")
     parser.add_argument("-r", action="store_true", default=False,
                         help="Reverse order.", dest="reverse_order")
     parser.add_argument("-s", action="store", type=str, default=' ',
@@ -56,9 +116,42 @@ def read_args(argv):
                         help="Key field.", dest="field")
     parser.add_argument("--types", action="store", type=str, dest="types",
                         help="Types of fields starting from key field.", default="")
+    parser.add_argument("-k", action="append", type=str, dest="key_specs", default=None,
+                        help="Key field with options n (integer), g (float), f (fold case) and r (reverse), "
+                             "e.g. -k 2n -k 1fr. Replaces -f and --types.")
+    parser.add_argument("-u", action="store_true", default=False, dest="unique",
+                        help="Output only the first line of lines with equal keys.")
+    parser.add_argument("-c", action="store_true", default=False, dest="count",
+                        help="Output the first line of lines with equal keys after their count.")
+    parser.add_argument("--head", action="store", type=int, dest="head", default=None,
+                        help="Output only the first N lines of the sorted order.")
+    parser.add_argument("--workdir", action="store", type=str, dest="workdir", default=None,
+                        help="Persistent directory for temporary files; an interrupted sort is resumed from it.")
     parser.add_argument("-m", action="store", type=int, dest="memory", default=2 ** 20)
+    parser.add_argument("-p", action="store", type=int, dest="processes", default=1,
+                        help="Count of processes for splitting.")
+    parser.add_argument("--runs", action="store", type=str, dest="run_formation", default="blocks",
+                        choices=["blocks", "replacement"],
+                        help="Run formation: sorted memory-sized blocks or replacement selection.")
+    parser.add_argument("-e", action="store", type=str, dest="encoding", default="utf-8",
+                        help="Encoding of key fields.")
+    parser.add_argument("--mmap", action="store_true", default=False, dest="use_mmap",
+                        help="Map the input file into memory while splitting.")
+    parser.add_argument("-z", action="store", type=str, dest="compression", default=None,
+                        choices=["zlib", "lzma"],
+                        help="Compress temporary files.")
+    parser.add_argument("--metrics", action="store", type=str, dest="metrics", default=None,
+                        help="File for time, lines, bytes and memory of every phase and process of the sort.")
+    parser.add_argument("--metrics-format", action="store", type=str, dest="metrics_format", default="json",
+                        choices=["json", "prometheus"],
+                        help="Format of the metrics file: JSON or Prometheus text format.")
+    parser.add_argument("--profile", action="store", type=str, dest="profile", default=None,
+                        help="Directory for cProfile statistics of the main process and of every worker.")
     result = parser.parse_args(argv)
     result.memory = int(max(result.memory // 3, 2 ** 20))
+    if result.processes < 1:
+        print("Count of processes must be positive.", file=sys.stderr)
+        sys.exit(6)
     types = {"n", "s"}
     for x in result.types:
         if x not in types:
@@ -72,6 +165,6 @@ if __name__ == "__main__":
         argv = read_args(sys.argv[1:])
     except ValueError:
         sys.exit(1)
-    time.clock()
+    start = time.perf_counter()
     main(argv)
-    print(time.clock())
+    print(time.perf_counter() - start, file=get_info_file(argv))
@@ -0,0 +1,142 @@
+import heapq
+import itertools
+import os
+import pickle
+import sys
+import tempfile
+from contextlib import ExitStack
+from operator import itemgetter
+
+from out_sort import out_sort, runs
+
+# List slot and key/item pair held for every buffered item besides the item itself.
+_ITEM_OVERHEAD = 72
+# Runs merged at once. Every open run and the output of a merge get an equal share of memory usage
+# for an unpickled chunk of items and a read buffer.
+_MERGE_WAYS = 16
+_READ_BUFFER = 2 ** 16
+_MIN_READ_BUFFER = 2 ** 10
+
+
+def _get_size(item):
+    # Containers are counted with their elements, one level deep.
+    size = sys.getsizeof(item)
+    if isinstance(item, dict):
+        size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in item.items())
+    elif isinstance(item, (tuple, list, set, frozenset)):
+        size += sum(sys.getsizeof(x) for x in item)
+    return size
+
+
+def _get_record_size(record, keyed):
+    # Records of sorts with a key are pairs of the key and the item.
+    if keyed:
+        return _get_size(record[0]) + _get_size(record[1]) + _ITEM_OVERHEAD
+    return _get_size(record) + _ITEM_OVERHEAD
+
+
+def _get_run_memory(memory_usage):
+    # Memory of a chunk and size of the read buffer of a run, so that a merge stays within memory usage.
+    share = memory_usage // (_MERGE_WAYS + 1)
+    return share // 2, min(max(share // 2, _MIN_READ_BUFFER), _READ_BUFFER)
+
+
+def _spill(records, filename, keyed, memory_usage, compression):
+    # Chunks are cut by their estimated memory, not by the count of items, for items may be of any size.
+    chunk_memory, buffer_size = _get_run_memory(memory_usage)
+    chunk = []
+    size = 0
+    with runs.open_run(filename, "wb", compression, buffer_size) as f:
+        for record in records:
+            chunk.append(record)
+            size += _get_record_size(record, keyed)
+            if size >= chunk_memory:
+                pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+                chunk = []
+                size = 0
+        if chunk:
+            pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+
+
+def _load(file):
+    while True:
+        try:
+            chunk = pickle.load(file)
+        except EOFError:
+            return
+        yield from chunk
+
+
+def _open_runs(stack, files, memory_usage, compression):
+    buffer_size = _get_run_memory(memory_usage)[1]
+    return [_load(stack.enter_context(runs.open_run(file, "rb", compression, buffer_size))) for file in files]
+
+
+def _merge_group(group, filename, merge_key, reverse_order, memory_usage, compression):
+    with ExitStack() as stack:
+        iters = _open_runs(stack, group, memory_usage, compression)
+        _spill(heapq.merge(*iters, key=merge_key, reverse=reverse_order), filename, merge_key is not None,
+               memory_usage, compression)
+    for file in group:
+        os.remove(file)
+    return filename
+
+
+def _merge_spilled(files, new_name, fan_in, merge_key, reverse_order, memory_usage, compression):
+    # Consecutive runs are merged in place of them, so items with equal keys keep their order.
+    while len(files) > fan_in:
+        files = [_merge_group(files[i:i + fan_in], new_name(), merge_key, reverse_order, memory_usage, compression)
+                 if len(files) - i > 1 else files[i] for i in range(0, len(files), fan_in)]
+    return files
+
+
+def _iter_sort(iterable, key, reverse_order, memory_usage, path, compression):
+    merge_key = itemgetter(0) if key is not None else None
+    keyed = key is not None
+    tempdir = None
+    files = []
+    names = itertools.count()
+    new_name = lambda: os.path.join(tempdir.name, str(next(names)))
+    buffered = []
+    size = 0
+    try:
+        for item in iterable:
+            if keyed:
+                item = (key(item), item)
+            buffered.append(item)
+            size += _get_record_size(item, keyed)
+            if size >= memory_usage:
+                if tempdir is None:
+                    tempdir = tempfile.TemporaryDirectory(dir=path)
+                buffered.sort(key=merge_key, reverse=reverse_order)
+                files.append(new_name())
+                _spill(buffered, files[-1], keyed, memory_usage, compression)
+                buffered = []
+                size = 0
+        buffered.sort(key=merge_key, reverse=reverse_order)
+        if files:
+            # The tail is spilled as well, for the memory of the final merge is taken by the chunks of the runs.
+            files.append(new_name())
+            _spill(buffered, files[-1], keyed, memory_usage, compression)
+            buffered = []
+            files = _merge_spilled(files, new_name, min(_MERGE_WAYS, out_sort._get_fan_in(len(files), memory_usage)),
+                                   merge_key, reverse_order, memory_usage, compression)
+        with ExitStack() as stack:
+            merged = buffered
+            if files:
+                merged = heapq.merge(*_open_runs(stack, files, memory_usage, compression), key=merge_key,
+                                     reverse=reverse_order)
+            if keyed:
+                merged = map(itemgetter(1), merged)
+            yield from merged
+    finally:
+        if tempdir is not None:
+            tempdir.cleanup()
+
+
+def iter_sort(iterable, key=None, reverse_order=False, memory_usage=2 ** 23, path=None, compression=None):
+    # Sorted items are produced lazily; runs are spilled to path only when memory_usage is exceeded.
+    if memory_usage < 0:
+        raise ValueError("Memory usage must be non-negative")
+    runs.check_compression(compression)
+    return _iter_sort(iterable, key, reverse_order, memory_usage, path, compression)
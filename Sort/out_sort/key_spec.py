@@ -0,0 +1,121 @@
+import re
+from functools import lru_cache
+
+from out_sort import keys
+
+_SPEC = re.compile(r"^([0-9]+)([nsgfr]*)$")
+_TYPES = {"s": str, "n": int, "g": float}
+
+
+class Parser:
+    # Key function compiled once per spec and process. It pickles as its spec, so pool workers
+    # rebuild it from their own cache instead of unpickling code.
+    __slots__ = ("spec", "_parse")
+
+    def __init__(self, spec, parse):
+        self.spec = spec
+        self._parse = parse
+
+    def __call__(self, line):
+        return self._parse(line)
+
+    def __reduce__(self):
+        return _compile, self.spec
+
+
+def parse_key(spec):
+    # Key like sort -k: field number followed by options n (integer), g (float), s (string),
+    # f (fold case) and r (reverse), e.g. "2nr".
+    match = _SPEC.match(spec)
+    if not match:
+        raise ValueError("Incorrect key {0}.".format(spec))
+    field, options = int(match.group(1)), match.group(2)
+    if field < 1:
+        raise ValueError("Incorrect number of field.")
+    types = [x for x in options if x in _TYPES]
+    if len(types) > 1:
+        raise ValueError("Key {0} has several types.".format(spec))
+    return field, _TYPES[types[0] if types else "s"], "r" in options, "f" in options
+
+
+def _encode_key(value, field_type, fold):
+    if field_type is str:
+        return keys.encode_string(value.casefold() if fold else value)
+    try:
+        value = field_type(value)
+    except ValueError:
+        raise ValueError("Incorrect type of field.")
+    if field_type is int:
+        return keys.encode_integer(value)
+    return keys.encode_float(value)
+
+
+def _compile_keys(specs, sep):
+    # One precomputed key from the named fields only; equal keys fall back to the whole line.
+    if not specs:
+        raise ValueError("Empty key specification.")
+    specs = [parse_key(spec) for spec in specs]
+    last_field = max(field for field, _, _, _ in specs)
+
+    def parse(line):
+        fields = [x for x in line.split(sep) if x]
+        if last_field > len(fields):
+            raise ValueError("Line have no {0} field\n{1}".format(last_field, line))
+        encoded = []
+        for field, field_type, reverse, fold in specs:
+            key = _encode_key(fields[field - 1], field_type, fold)
+            encoded.append(keys.encode_reversed(key) if reverse else key)
+        return [b"".join(encoded)], line
+
+    return parse
+
+
+def _compile_fields(sep, field, types):
+    # Same result as out_sort._split_line: fields from the key field on, then the others, numbers converted.
+    if field < 1:
+        raise ValueError("Incorrect number of field.")
+    numeric = tuple(i for i, field_type in enumerate(types) if field_type == "n")
+
+    def split(line):
+        ans = [x for x in line.split(sep) if x]
+        if field > len(ans):
+            raise ValueError("Line have no {0} field\n{1}".format(field, line))
+        return ans
+
+    def rotate(line):
+        ans = split(line)
+        return ans[field - 1:] + ans[:field - 1]
+
+    fields = split if field == 1 else rotate
+    if not numeric:
+        return lambda line: (fields(line), line)
+
+    def parse(line):
+        ans = fields(line)
+        try:
+            for i in numeric:
+                if i >= len(ans):
+                    break
+                ans[i] = int(ans[i])
+        except ValueError:
+            raise ValueError("Incorrect type of field.")
+        return ans, line
+
+    return parse
+
+
+@lru_cache(maxsize=64)
+def _compile(sep, field, types, key_specs):
+    if key_specs is not None:
+        parse = _compile_keys(key_specs, sep)
+    else:
+        parse = _compile_fields(sep, field, types)
+    return Parser((sep, field, types, key_specs), parse)
+
+
+def compile_parser(sep=" ", field=1, types="", key_specs=None):
+    return _compile(sep, field, types, key_specs)
+
+
+def compile_keys(specs, sep=" "):
+    return compile_parser(sep, key_specs=tuple(specs))
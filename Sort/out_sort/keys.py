@@ -0,0 +1,70 @@
+import struct
+
+_END = b"\x00"
+END = _END
+_STRING = b"\x01"
+_NEGATIVE_BIG = b"\x02"
+_INTEGER = b"\x03"
+INTEGER_TAG = _INTEGER[0]
+_POSITIVE_BIG = b"\x04"
+_FLOAT = b"\x05"
+_INT64 = struct.Struct(">Q")
+_DOUBLE = struct.Struct(">d")
+_SIGN = 2 ** 63
+_COMPLEMENT = bytes(range(255, -1, -1))
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
+_MAX_LENGTH = 255
+
+
+def encode_string(value):
+    return _STRING + value.encode("utf-8", "surrogatepass").replace(b"\x00", b"\x00\xff") + b"\x00\x00"
+
+
+def encode_utf8_strings(values):
+    # Same as encode_string of every value for UTF-8 bytes without zero bytes, joined at once.
+    if not values:
+        return b""
+    return _STRING + (b"\x00\x00" + _STRING).join(values) + b"\x00\x00"
+
+
+def encode_integer(value):
+    if _INT64_MIN <= value <= _INT64_MAX:
+        return _INTEGER + _INT64.pack(value - _INT64_MIN)
+    length = (abs(value).bit_length() + 7) // 8
+    if length > _MAX_LENGTH:
+        raise ValueError("Too long number.")
+    if value > 0:
+        return _POSITIVE_BIG + bytes([length]) + value.to_bytes(length, "big")
+    magnitude = (-value).to_bytes(length, "big")
+    return _NEGATIVE_BIG + bytes([_MAX_LENGTH - length]) + bytes(_MAX_LENGTH - x for x in magnitude)
+
+
+def encode_float(value):
+    # Negative numbers have every bit flipped, the others only the sign bit; -0.0 is the same as 0.0.
+    bits = _INT64.unpack(_DOUBLE.pack(value + 0.0))[0]
+    return _FLOAT + _INT64.pack(bits ^ (2 * _SIGN - 1) if bits & _SIGN else bits | _SIGN)
+
+
+def encode_reversed(encoded):
+    # Every encoding is prefix-free, so the complement of its bytes compares in the opposite order.
+    return encoded.translate(_COMPLEMENT)
+
+
+def encode_fields(fields):
+    # Bytes of the result compare in the same order as the list of fields.
+    # Bytes fields are taken as keys encoded already.
+    encoded = []
+    for field in fields:
+        if isinstance(field, str):
+            encoded.append(encode_string(field))
+        elif isinstance(field, int):
+            encoded.append(encode_integer(field))
+        elif isinstance(field, float):
+            encoded.append(encode_float(field))
+        elif isinstance(field, bytes):
+            encoded.append(field)
+        else:
+            raise ValueError("Unsupported type of field {0}.".format(type(field).__name__))
+    encoded.append(_END)
+    return b"".join(encoded)
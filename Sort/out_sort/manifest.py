@@ -0,0 +1,92 @@
+import json
+import os
+import re
+
+MANIFEST = "manifest"
+# Subdirectory of the work directory owned by a resumable sort; files of the user around it are never touched.
+RUNS = "out_sort.runs"
+# Files a sort writes to its work directory: runs of the split, merged runs and their indexes.
+_RUN_FILE = re.compile(r"^m?[0-9]+(\.idx)?$")
+
+
+class Manifest:
+    # Append-only log of a resumable sort kept in its work directory. Every line is a finished run,
+    # the end of the split or a finished merge, so a restarted sort of the same job skips what is done.
+    def __init__(self, path, job):
+        self.path = path
+        self.ready = []
+        self.count_of_runs = 0
+        self.count_of_merges = 0
+        self.split_done = False
+        filename = os.path.join(path, MANIFEST)
+        events = _load(filename)
+        if events and events[0] == {"job": job}:
+            for event in events[1:]:
+                self._replay(event)
+        if not self.split_done:
+            # Runs of an unfinished split can not be matched to the input, so the split starts over.
+            self.ready = []
+            self.count_of_runs = 0
+            self.count_of_merges = 0
+        self._remove_files(set(self.ready))
+        self.ready = [os.path.join(path, name) for name in self.ready]
+        if self.split_done:
+            self._file = open(filename, "a")
+        else:
+            self._file = open(filename, "w")
+            self._write({"job": job})
+
+    def _replay(self, event):
+        if "run" in event:
+            self.ready.append(event["run"])
+            self.count_of_runs += 1
+        elif "split" in event:
+            self.split_done = True
+        elif "merge" in event:
+            inputs = set(event["inputs"])
+            self.ready = [name for name in self.ready if name not in inputs]
+            self.ready.append(event["merge"])
+            self.count_of_merges = max(self.count_of_merges, int(event["merge"][1:]) + 1)
+
+    def _remove_files(self, keep):
+        # Partial outputs of interrupted merges and inputs of recorded ones are removed.
+        for name in os.listdir(self.path):
+            if _RUN_FILE.match(name) and name.split(".")[0] not in keep:
+                os.remove(os.path.join(self.path, name))
+
+    def _write(self, event):
+        self._file.write(json.dumps(event) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def add_run(self, filename):
+        self.count_of_runs += 1
+        self._write({"run": os.path.basename(filename)})
+
+    def finish_split(self):
+        self.split_done = True
+        self._write({"split": self.count_of_runs})
+
+    def add_merge(self, filename, inputs):
+        self._write({"merge": os.path.basename(filename), "inputs": [os.path.basename(name) for name in inputs]})
+
+    def remove(self):
+        # The sort is finished: its runs and the manifest are no longer needed.
+        self._file.close()
+        self._remove_files(set())
+        os.remove(os.path.join(self.path, MANIFEST))
+
+
+def _load(filename):
+    events = []
+    try:
+        with open(filename) as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # The last line may be cut by a crash.
+                    break
+    except FileNotFoundError:
+        pass
+    return events
@@ -1,69 +1,739 @@
 import os
+import stat
+import sys
+import time
+import cProfile
 import dill
 import heapq
-import time
-import shutil
+import warnings
 import asyncio
+import codecs
 import aiofiles
 import io
+import pickle
+import itertools
+import queue
+import mmap
+from array import array
+from collections import deque
 from multiprocessing import Pool
-from contextlib import contextmanager
-from multiprocessing import Manager
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache, partial
+from operator import itemgetter
+from multiprocessing import Array, Value
+from multiprocessing.util import Finalize
+from out_sort import key_spec, keys, runs
+from out_sort.manifest import RUNS, Manifest
+from out_sort.sort_statistic import METRICS
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_MIN_BLOCK_SIZE = 2 ** 16
+_MEMORY_FACTOR = 4
+_MIN_READ_BUFFER = 2 ** 12
+_DEFAULT_DESCRIPTOR_LIMIT = 256
+_RESERVED_DESCRIPTORS = 16
+STREAM = "-"
+AGGREGATES = ("unique", "count")
+_PROGRESS_INTERVAL = 0.1
+
+# Progress counters of a pool worker: shared array of bytes written and the index of this worker's slot.
+_counters = None
+_slot = None
+# Counters of METRICS for this process: a row of the pool's shared array in a worker, an own array in the main one.
+_metrics = array("q", [0] * len(METRICS))
+_metrics_offset = 0
+_METRIC_INDEX = {name: i for i, name in enumerate(METRICS)}
+# Profiler of a worker of a profiled pool and the file its statistics are dumped to when the worker exits.
+_profiler = None
+_profile_file = None
+_NUMERIC_BYTES = frozenset(b"0123456789+- \n")
+_MAX_NUMERIC_LENGTH = 18
+# Bytes held per line of an mmap run besides its key: key object header, list slots and offsets.
+_MMAP_LINE_OVERHEAD = 96
+# Index entries used to choose the splitters of a partitioned final merge.
+_MAX_SAMPLES = 2 ** 12
 
 
 @contextmanager
-def range_open(files, mode, buffering=io.DEFAULT_BUFFER_SIZE):
+def range_open(files, mode, buffering=io.DEFAULT_BUFFER_SIZE, compression=None):
     opened_files = []
     try:
-        opened_files = [open(file, mode, buffering=buffering) for file in files]
+        opened_files = [runs.open_run(file, mode, compression, buffering) for file in files]
         yield opened_files
     finally:
         for file in opened_files:
             file.close()
 
 
-async def _buffered_print(buffered, output_filename, buffer_size):
-    async with aiofiles.open(output_filename, "w", buffering=buffer_size) as out_file:
-        await out_file.write("\n".join(buffered) + "\n")
-    return os.path.getsize(output_filename)
+def _open_input(filename, buffering=-1):
+    if filename == STREAM:
+        return open(sys.stdin.fileno(), "rb", buffering, closefd=False)
+    return open(filename, "rb", buffering)
+
+
+def _open_output(filename, buffering=-1, compression=None):
+    if filename == STREAM:
+        return open(sys.stdout.fileno(), "wb", buffering, closefd=False)
+    return runs.open_run(filename, "wb", compression, buffering)
+
+
+def _get_input_size(filename):
+    # Size of a regular file, None for pipes, terminals and other streams.
+    if filename == STREAM:
+        return None
+    try:
+        file_stat = os.stat(filename)
+    except OSError:
+        return None
+    if not stat.S_ISREG(file_stat.st_mode):
+        return None
+    return file_stat.st_size
+
+
+def _add_metric(name, value):
+    # Like printed sizes, every process adds to its own counters only.
+    _metrics[_metrics_offset + _METRIC_INDEX[name]] += value
+
+
+def _elapsed_ns(start):
+    return int((time.perf_counter() - start) * 10 ** 9)
+
+
+def _update_peak_rss():
+    if resource is not None:
+        i = _metrics_offset + _METRIC_INDEX["peak_rss_bytes"]
+        _metrics[i] = max(_metrics[i], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+
+def _report_run(filename):
+    _add_metric("runs", 1)
+    _add_metric("written_bytes", os.path.getsize(filename))
+
+
+@contextmanager
+def _task_metrics():
+    # Wall and CPU time and peak memory of a task of a worker, which is profiled if the pool profiles.
+    start, cpu_start = time.perf_counter(), time.process_time()
+    if _profiler is not None:
+        _profiler.enable()
+    try:
+        yield
+    finally:
+        if _profiler is not None:
+            _profiler.disable()
+        _add_metric("tasks", 1)
+        _add_metric("wall_ns", _elapsed_ns(start))
+        _add_metric("cpu_ns", int((time.process_time() - cpu_start) * 10 ** 9))
+        _update_peak_rss()
+
+
+async def _buffered_print(buffered, output_filename, buffer_size, compression=None, indexed=False):
+    async with aiofiles.open(output_filename, "wb", buffering=buffer_size) as out_file:
+        await out_file.write(runs.compress(runs.dump_records(buffered), compression))
+    if indexed and compression is None:
+        _write_index(buffered, output_filename)
+    _report_run(output_filename)
+    return sum(len(line) for _, line in buffered)
+
+
+def _write_index(records, filename):
+    index = runs.RunIndex()
+    index.extend(records)
+    index.dump(filename)
+
+
+def _make_records(lines, parser, encoding="utf-8"):
+    encode = keys.encode_fields
+    start = time.perf_counter()
+    records = [(encode(parser(line.decode(encoding))[0]), line + b"\n") for line in lines if line]
+    _add_metric("lines", len(records))
+    _add_metric("key_ns", _elapsed_ns(start))
+    return records
+
+
+def _read_blocks(file, block_size):
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    while True:
+        count = file.readinto(view)
+        if not count:
+            return
+        block = b"".join((view[:count], file.readline()))
+        _add_metric("read_bytes", len(block))
+        yield block.split(b"\n")
+
+
+def _get_numeric_columns(sep, field, types):
+    # Key fields of the vectorized path: numbers only, counted from the key field.
+    if np is None or not types or set(types) != {"n"}:
+        return None
+    return sep, field, len(types)
+
+
+def _numeric_records(lines, numeric_columns, reverse_order, encoding):
+    # Vectorized path for numeric key fields; None means it does not apply and the parser is used.
+    sep, field, count_of_columns = numeric_columns
+    sep = sep.encode(encoding)
+    if not lines or not sep or _NUMERIC_BYTES.intersection(sep.replace(b" ", b"")):
+        return None
+    if field == 1:
+        records = _numeric_lines_records(lines, sep, count_of_columns, reverse_order)
+        if records is not None:
+            return records
+    return _numeric_fields_records(lines, sep, field, count_of_columns, reverse_order, encoding)
+
+
+def _parse_numbers(data, count):
+    # Integers of space separated data, None unless there are exactly count of them and all fit int64.
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        try:
+            values = np.fromstring(data.decode("ascii"), dtype=np.int64, sep=" ")
+        except (ValueError, DeprecationWarning, UnicodeDecodeError):
+            return None
+    return values if len(values) == count else None
+
+
+def _encode_numbers(values):
+    # Keys of rows of int64 values, the same as keys.encode_integer of every value without the end byte.
+    count_of_rows, count_of_columns = values.shape
+    width = 9 * count_of_columns
+    encoded = np.zeros((count_of_rows, width), dtype=np.uint8)
+    encoded[:, 0:width:9] = keys.INTEGER_TAG
+    shifted = (values.view(np.uint64) ^ np.uint64(2 ** 63)).astype(">u8")
+    for column in range(count_of_columns):
+        encoded[:, 9 * column + 1:9 * column + 9] = shifted[:, column:column + 1].view(np.uint8)
+    encoded = encoded.tobytes()
+    return [encoded[i * width:(i + 1) * width] for i in range(count_of_rows)]
+
+
+def _order_records(values, records, reverse_order):
+    # Records ordered by their numbers with lexsort; only records with equal numbers are compared in full.
+    order = np.lexsort(values.T[::-1])
+    sorted_values = values[order]
+    same = (sorted_values[1:] == sorted_values[:-1]).all(axis=1)
+    bounds = np.flatnonzero(np.diff(np.concatenate(([False], same, [False])).astype(np.int8)))
+    order = order.tolist()
+    for left, right in bounds.reshape(-1, 2).tolist():
+        order[left:right + 1] = sorted(order[left:right + 1], key=records.__getitem__)
+    if reverse_order:
+        order.reverse()
+    return [records[i] for i in order]
+
+
+def _numeric_lines_records(lines, sep, count_of_columns, reverse_order):
+    # Lines made only of numeric key fields are parsed as one block.
+    data = b"\n".join(lines)
+    if sep != b" ":
+        if b" " in data:
+            return None
+        data = data.replace(sep, b" ")
+    chars = np.frombuffer(data, dtype=np.uint8)
+    if not np.isin(chars, np.frombuffer(bytes(_NUMERIC_BYTES), dtype=np.uint8)).all():
+        return None
+    is_space = (chars == ord(" ")) | (chars == ord("\n"))
+    before = np.concatenate(([True], is_space[:-1]))
+    after = np.concatenate((is_space[1:], [True]))
+    starts = np.flatnonzero(~is_space & before)
+    ends = np.flatnonzero(~is_space & after)
+    if (ends - starts + 1 > _MAX_NUMERIC_LENGTH).any():
+        return None
+    line_numbers = np.cumsum(chars == ord("\n"))
+    counts = np.bincount(line_numbers[starts], minlength=len(lines))
+    if (counts != count_of_columns).any():
+        return None
+    values = _parse_numbers(data, len(lines) * count_of_columns)
+    if values is None:
+        return None
+    values = values.reshape(len(lines), count_of_columns)
+    encoded = _encode_numbers(values)
+    return _order_records(values, [(key + keys.END, line + b"\n") for key, line in zip(encoded, lines)],
+                          reverse_order)
+
+
+def _numeric_fields_records(lines, sep, field, count_of_columns, reverse_order, encoding):
+    # Lines with other fields, e.g. log lines keyed by a timestamp: only the numeric key fields are parsed
+    # at once, the rest of every line becomes string keys, which are compared only for equal numbers.
+    # Text that is not UTF-8 or has zero bytes would be encoded otherwise, so it is left to the parser.
+    if codecs.lookup(encoding).name != "utf-8":
+        return None
+    block = b"\n".join(lines)
+    if b"\x00" in block:
+        return None
+    try:
+        block.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+    first, last = field - 1, field - 1 + count_of_columns
+    encode = keys.encode_utf8_strings
+    numbers = []
+    tails = []
+    for line in lines:
+        fields = [x for x in line.split(sep) if x]
+        if len(fields) < last:
+            return None
+        numbers.extend(fields[first:last])
+        tails.append(encode(fields[last:] + fields[:first]) + keys.END)
+    if max(map(len, numbers)) > _MAX_NUMERIC_LENGTH:
+        return None
+    data = b" ".join(numbers)
+    if not _NUMERIC_BYTES.issuperset(data):
+        return None
+    values = _parse_numbers(data, len(lines) * count_of_columns)
+    if values is None:
+        return None
+    values = values.reshape(len(lines), count_of_columns)
+    encoded = _encode_numbers(values)
+    return _order_records(values, [(key + tail, line + b"\n") for key, tail, line in zip(encoded, tails, lines)],
+                          reverse_order)
+
+
+def _sort_records(lines, parser, reverse_order, encoding, numeric_columns, aggregate=None):
+    lines = [line for line in lines if line]
+    records = None
+    if numeric_columns:
+        start = time.perf_counter()
+        records = _numeric_records(lines, numeric_columns, reverse_order, encoding)
+        if records is not None:
+            # Numeric keys are parsed, encoded and ordered at once, so key time includes their sort.
+            _add_metric("lines", len(records))
+            _add_metric("key_ns", _elapsed_ns(start))
+    if records is None:
+        records = _make_records(lines, parser, encoding)
+        records.sort(reverse=reverse_order)
+    if aggregate:
+        records = list(_aggregate(records, aggregate))
+    return records
+
+
+def _check_aggregate(aggregate):
+    if aggregate is not None and aggregate not in AGGREGATES:
+        raise ValueError("Unknown aggregate {0}. Expected one of {1}.".format(aggregate, ", ".join(AGGREGATES)))
+
+
+def _aggregate(records, aggregate, counted=False, reverse_order=False):
+    # Sorted records with equal keys become one record with the first line of the group.
+    # In count mode the key is followed by the count of lines, which the records of merged runs already have.
+    if aggregate == "unique":
+        for _, group in itertools.groupby(records, key=itemgetter(0)):
+            yield next(group)
+        return
+    pack, unpack = runs.pack_count, runs.unpack_count
+    if not counted:
+        for key, group in itertools.groupby(records, key=itemgetter(0)):
+            line = next(group)[1]
+            yield key + pack(1 + sum(1 for _ in group)), line
+        return
+    # Records of merged runs with equal keys are ordered by their counts, so the first line is looked for.
+    size = runs.COUNT_SIZE
+    for key, group in itertools.groupby(records, key=lambda record: record[0][:-size]):
+        count = 0
+        first = None
+        for counted_key, line in group:
+            count += unpack(counted_key[-size:])
+            if first is None or (line > first if reverse_order else line < first):
+                first = line
+        yield key + pack(count), first
+
+
+def _count_lines(records):
+    # Final lines of count mode start with the count of lines with the key, as in uniq -c.
+    size = runs.COUNT_SIZE
+    unpack = runs.unpack_count
+    for key, line in records:
+        yield key, b"%d " % unpack(key[-size:]) + line
 
 
-def split_file(filename, reverse_order, parser, memory_usage, path, loop, statistic=None):
+def _finish_split(path, count_of_files, run_callback=None):
+    if not count_of_files:
+        open(os.path.join(path, str(count_of_files)), "wb").close()
+        count_of_files += 1
+        if run_callback:
+            run_callback(os.path.join(path, "0"))
+    return count_of_files
+
+
+def sort_in_memory(filename, output_filename, reverse_order, parser, statistic=None, encoding="utf-8",
+                   numeric_columns=None, aggregate=None):
     if statistic:
-        statistic.next_state(os.path.getsize(filename))
+        statistic.next_state(_get_input_size(filename))
+        statistic.print()
+    with _open_input(filename) as f:
+        data = f.read()
+    _add_metric("read_bytes", len(data))
+    records = _sort_records(data.split(b"\n"), parser, reverse_order, encoding, numeric_columns, aggregate)
+    del data
+    if aggregate == "count":
+        records = list(_count_lines(records))
+    with _open_output(output_filename) as f:
+        f.write(b"".join(line for _, line in records))
+    if statistic:
+        statistic.add_printed(sum(len(line) for _, line in records))
+        statistic.next_state(0)
+        statistic.print()
+
+
+def sort_head(filename, output_filename, head, path, reverse_order, parser, memory_usage, statistic=None,
+              encoding="utf-8", numeric_columns=None, aggregate=None, compression=None, pool=None, profile=None):
+    # First head lines of the sorted order in one pass over the input. They are kept in memory, merged with every
+    # sorted block; only if they do not fit, every block becomes a run cut to head lines.
+    if statistic:
+        statistic.next_state(_get_input_size(filename))
+        statistic.print()
+    if head < 0:
+        raise ValueError("Count of lines must be non-negative")
+    if memory_usage < 0:
+        raise ValueError("Memory usage must be non-negative")
+    block_size = _get_block_size(memory_usage, 2)
+    best = []
+    scheduler = None
+    with ExitStack() as stack:
+        f = stack.enter_context(_open_input(filename, block_size))
+        for lines in _read_blocks(f, block_size):
+            size = sum(len(line) + 1 for line in lines) - 1
+            records = _sort_records(lines, parser, reverse_order, encoding, numeric_columns, aggregate)[:head]
+            if scheduler is None:
+                best = list(_merge_records((best, records), reverse_order, aggregate, head))
+                if sum(len(key) + len(line) for key, line in best) * _MEMORY_FACTOR > memory_usage:
+                    pool = stack.enter_context(use_pool(pool, profile=profile))
+                    scheduler = _MergeScheduler(pool, path, int(max(2 ** 20, memory_usage)), reverse_order,
+                                                compression, aggregate, head)
+                    records, best = best, []
+            if scheduler is not None:
+                name = os.path.join(path, str(scheduler.count_of_runs))
+                _write_run(records, name, compression)
+                scheduler.add_run(name)
+            __add_printed(size, statistic)
+        if scheduler is not None:
+            _merge_runs(filename, output_filename, scheduler, statistic)
+            return
+    if aggregate == "count":
+        best = _count_lines(best)
+    with _open_output(output_filename) as f:
+        f.write(b"".join(line for _, line in best))
+    if statistic:
+        statistic.next_state(0)
+        statistic.print()
+
+
+def _get_block_size(memory_usage, count_of_blocks):
+    return max(memory_usage // (count_of_blocks * _MEMORY_FACTOR), _MIN_BLOCK_SIZE)
+
+
+def split_file(filename, reverse_order, parser, memory_usage, path, loop, statistic=None,
+               block_size=_MIN_BLOCK_SIZE, encoding="utf-8", numeric_columns=None, compression=None,
+               run_callback=None, aggregate=None, indexed=False):
+    if statistic:
+        statistic.next_state(_get_input_size(filename))
         statistic.print()
     if memory_usage < 0:
         raise ValueError("Memory usage must be non-negative")
     if loop.is_closed():
         raise ValueError("Loop closed")
     count_of_files = 0
-    block_size = 2 ** 16
-    count_of_coros = memory_usage // block_size
+    count_of_coros = max(memory_usage // (block_size * _MEMORY_FACTOR), 1)
     coros = set()
-    with open(filename, "r", memory_usage) as f:
-        while True:
-            buffered = f.read(block_size)
-            adding = f.readline()
-            buffered += adding
-            buffered = [line for line in buffered.split("\n") if line]
-            buffered.sort(key=parser, reverse=reverse_order)
-            coros.add(_buffered_print(buffered, os.path.join(path, str(count_of_files)), block_size))
+    names = {}
+    with _open_input(filename, memory_usage) as f:
+        for lines in _read_blocks(f, block_size):
+            buffered = _sort_records(lines, parser, reverse_order, encoding, numeric_columns, aggregate)
+            name = os.path.join(path, str(count_of_files))
+            coro = loop.create_task(_buffered_print(buffered, name, block_size, compression, indexed))
+            names[coro] = name
+            coros.add(coro)
             count_of_files += 1
             if len(coros) >= count_of_coros:
                 done, coros = loop.run_until_complete(asyncio.wait(coros, return_when=asyncio.FIRST_COMPLETED))
-                if statistic:
-                    for coro in done:
-                        statistic.add_printed(coro.result())
-                    statistic.print()
-            if not adding:
-                break
+                __finish_runs(done, names, statistic, run_callback)
     while coros:
         done, coros = loop.run_until_complete(asyncio.wait(coros, return_when=asyncio.FIRST_COMPLETED))
+        __finish_runs(done, names, statistic, run_callback)
+    return _finish_split(path, count_of_files, run_callback)
+
+
+def __finish_runs(done, names, statistic, run_callback):
+    for coro in done:
+        size = coro.result()
         if statistic:
-            for coro in done:
-                statistic.add_printed(coro.result())
-                statistic.print()
-    return count_of_files
+            statistic.add_printed(size)
+        if run_callback:
+            run_callback(names.pop(coro))
+    if statistic:
+        statistic.print()
+
+
+def get_blocks(filename, block_size):
+    # Offset and length of every block of the file, each extended to the end of its last line.
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset < size:
+            f.seek(offset + block_size)
+            f.readline()
+            end = min(f.tell(), size)
+            yield offset, end - offset
+            offset = end
+
+
+def dump_parser(parser):
+    # Compiled parsers pickle by reference to their spec; only other callables, such as lambdas, need dill.
+    try:
+        pickle.dumps(parser)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return dill.dumps(parser)
+    return parser
+
+
+@lru_cache(maxsize=16)
+def load_parser(parser):
+    # Workers of a long-lived pool unpickle every dill parser only once.
+    return dill.loads(parser)
+
+
+@_task_metrics()
+def _sort_block(filename, offset, length, parser, reverse_order, output_filename, encoding, numeric_columns,
+                compression, aggregate=None, indexed=False):
+    if isinstance(parser, bytes):
+        parser = load_parser(parser)
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        buffered = f.read(length)
+    _add_metric("read_bytes", length)
+    buffered = _sort_records(buffered.split(b"\n"), parser, reverse_order, encoding, numeric_columns, aggregate)
+    _write_run(buffered, output_filename, compression, indexed)
+    return length
+
+
+def _write_run(records, output_filename, compression=None, indexed=False):
+    with open(output_filename, "wb") as out_file:
+        out_file.write(runs.compress(runs.dump_records(records), compression))
+    if indexed and compression is None:
+        _write_index(records, output_filename)
+    _report_run(output_filename)
+
+
+def split_file_parallel(filename, reverse_order, parser, memory_usage, path, processes=None, statistic=None,
+                        block_size=_MIN_BLOCK_SIZE, encoding="utf-8", numeric_columns=None, compression=None,
+                        pool=None, run_callback=None, aggregate=None, indexed=False):
+    if statistic:
+        statistic.next_state(os.path.getsize(filename))
+        statistic.print()
+    if memory_usage < 0:
+        raise ValueError("Memory usage must be non-negative")
+    parser = dump_parser(parser)
+    count_of_files = 0
+    with use_pool(pool, processes) as pool:
+        # Blocks in flight are bounded by the memory budget as well as by the count of processes.
+        processes = min(processes or pool.processes, pool.processes)
+        count_of_blocks = min(2 * processes, max(memory_usage // (block_size * _MEMORY_FACTOR), 1))
+        tasks = ((filename, offset, length, parser, reverse_order, os.path.join(path, str(i)), encoding,
+                  numeric_columns, compression, aggregate, indexed)
+                 for i, (offset, length) in enumerate(get_blocks(filename, block_size)))
+        for length in bounded_map(pool, _sort_block, tasks, count_of_blocks):
+            __add_printed(length, statistic)
+            if run_callback:
+                run_callback(os.path.join(path, str(count_of_files)))
+            count_of_files += 1
+    return _finish_split(path, count_of_files, run_callback)
+
+
+def bounded_map(pool, func, tasks, window):
+    # Results of func for every tuple of arguments in order; at most window tasks are in flight,
+    # so tasks are not read ahead of the consumer of the results.
+    workers = deque()
+    for args in tasks:
+        workers.append(pool.apply_async(func, args))
+        if len(workers) >= window:
+            yield workers.popleft().get()
+    while workers:
+        yield workers.popleft().get()
+
+
+def __add_printed(size, statistic):
+    if not statistic:
+        return
+    statistic.add_printed(size)
+    statistic.print()
+
+
+def _sort_offsets(data, starts, ends, line_keys, reverse_order):
+    order = sorted(range(len(line_keys)), key=line_keys.__getitem__, reverse=reverse_order)
+    left = 0
+    while left < len(order):
+        right = left + 1
+        while right < len(order) and line_keys[order[right]] == line_keys[order[left]]:
+            right += 1
+        if right - left > 1:
+            # Records are ordered by the line with its newline, as in the other split modes.
+            order[left:right] = sorted(order[left:right], key=lambda i: data[starts[i]:ends[i]] + b"\n",
+                                       reverse=reverse_order)
+        left = right
+    return array("Q", order)
+
+
+def _write_mmap_run(data, starts, ends, line_keys, order, output_filename, compression=None, aggregate=None,
+                    indexed=False):
+    pack = runs.pack_header
+    index = runs.RunIndex() if indexed and compression is None else None
+    records = ((line_keys[i], data[starts[i]:ends[i]] + b"\n") for i in order)
+    if aggregate:
+        records = _aggregate(records, aggregate)
+    with runs.open_run(output_filename, "wb", compression, _MIN_BLOCK_SIZE) as out_file:
+        write = out_file.write
+        for key, line in records:
+            write(pack(len(key)))
+            write(key)
+            write(line)
+            if index:
+                index.add(key, line)
+    if index:
+        index.dump(output_filename)
+    _report_run(output_filename)
+
+
+def split_file_mmap(filename, reverse_order, parser, memory_usage, path, statistic=None, encoding="utf-8",
+                    compression=None, run_callback=None, aggregate=None, indexed=False):
+    if statistic:
+        statistic.next_state(os.path.getsize(filename))
+        statistic.print()
+    if memory_usage < 0:
+        raise ValueError("Memory usage must be non-negative")
+    encode = keys.encode_fields
+    count_of_files = 0
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return _finish_split(path, count_of_files, run_callback)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            find = data.find
+            start = 0
+            while start < size:
+                run_start = start
+                parse_start = time.perf_counter()
+                starts, ends = array("Q"), array("Q")
+                line_keys = []
+                run_memory = 0
+                # Every run takes at least one line, so a zero budget still advances through the file.
+                while start < size and (run_memory < memory_usage or not line_keys):
+                    end = find(b"\n", start)
+                    if end < 0:
+                        end = size
+                    if end > start:
+                        key = encode(parser(data[start:end].decode(encoding))[0])
+                        line_keys.append(key)
+                        starts.append(start)
+                        ends.append(end)
+                        run_memory += len(key) + _MMAP_LINE_OVERHEAD
+                    start = end + 1
+                _add_metric("lines", len(line_keys))
+                _add_metric("key_ns", _elapsed_ns(parse_start))
+                _add_metric("read_bytes", min(start, size) - run_start)
+                order = _sort_offsets(data, starts, ends, line_keys, reverse_order)
+                name = os.path.join(path, str(count_of_files))
+                _write_mmap_run(data, starts, ends, line_keys, order, name, compression, aggregate, indexed)
+                count_of_files += 1
+                __add_printed(min(start, size) - run_start, statistic)
+                if run_callback:
+                    run_callback(name)
+    return _finish_split(path, count_of_files, run_callback)
+
+
+class _Reversed:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def replacement_selection(filename, reverse_order, parser, memory_usage, path, statistic=None, encoding="utf-8",
+                          compression=None, run_callback=None, aggregate=None, indexed=False):
+    if statistic:
+        statistic.next_state(_get_input_size(filename))
+        statistic.print()
+    if memory_usage < 0:
+        raise ValueError("Memory usage must be non-negative")
+    wrap = _Reversed if reverse_order else lambda key: key
+    heap = []
+    heap_size = 0
+    with _open_input(filename, _MIN_BLOCK_SIZE) as f:
+        blocks = (_make_records(lines, parser, encoding) for lines in _read_blocks(f, _MIN_BLOCK_SIZE))
+        records = itertools.chain.from_iterable(blocks)
+        for record in records:
+            heap.append((0, wrap(record)))
+            heap_size += len(record[1]) * _MEMORY_FACTOR
+            if heap_size >= memory_usage:
+                break
+        heapq.heapify(heap)
+        count_of_files = 0
+        out_file = None
+        index = None
+        buffered = []
+        current_size = 0
+        try:
+            while heap:
+                run, key = heap[0]
+                if out_file is None or run != count_of_files - 1:
+                    current_size = __flush_run(out_file, buffered, current_size, statistic, index, aggregate)
+                    if out_file:
+                        out_file.close()
+                        __finish_run(os.path.join(path, str(count_of_files - 1)), index, run_callback)
+                    out_file = runs.open_run(os.path.join(path, str(count_of_files)), "wb", compression,
+                                             _MIN_BLOCK_SIZE)
+                    index = runs.RunIndex() if indexed and compression is None else None
+                    count_of_files += 1
+                record = key.value if reverse_order else key
+                buffered.append(record)
+                current_size += len(record[1])
+                if current_size >= _MIN_BLOCK_SIZE:
+                    current_size = __flush_run(out_file, buffered, current_size, statistic, index, aggregate)
+                next_record = next(records, None)
+                if next_record is None:
+                    heapq.heappop(heap)
+                    continue
+                next_key = wrap(next_record)
+                heapq.heapreplace(heap, (run + int(next_key < key), next_key))
+            __flush_run(out_file, buffered, current_size, statistic, index, aggregate)
+        finally:
+            if out_file:
+                out_file.close()
+        if out_file:
+            __finish_run(os.path.join(path, str(count_of_files - 1)), index, run_callback)
+    return _finish_split(path, count_of_files, run_callback)
+
+
+def __flush_run(out_file, buffered, current_size, statistic, index=None, aggregate=None):
+    if buffered:
+        # Equal keys are combined inside one flushed block only; merges combine the rest.
+        records = list(_aggregate(buffered, aggregate)) if aggregate else buffered
+        out_file.write(runs.dump_records(records))
+        if index:
+            index.extend(records)
+        buffered.clear()
+        __add_printed(current_size, statistic)
+    return 0
+
+
+def __finish_run(filename, index, run_callback):
+    if index:
+        index.dump(filename)
+    _report_run(filename)
+    if run_callback:
+        run_callback(filename)
 
 
 def _split_line(line, sep=" ", field=1, types=""):
@@ -83,37 +753,222 @@ def _split_line(line, sep=" ", field=1, types=""):
     return ans, line
 
 
-def _merge_files(output_filename, parser, begin, end, buffer_size, path, reverse_order, queue, lock):
-    files = [os.path.join(path, str(i)) for i in range(begin, end)]
-    parser = dill.loads(parser)
-    with range_open(files, "r", buffer_size) as iters:
-        buffer_size //= 20
-        printed = 0
-        buffered = []
-        current_size = 0
-        append = buffered.append
-        for line in heapq.merge(*iters, reverse=reverse_order, key=parser):
-            append(line)
-            current_size += len(line)
-            if current_size > buffer_size:
-                with open(output_filename, "a") as f:
-                    f.write(''.join(buffered))
-                buffered = []
-                append = buffered.append
-                current_size = 0
-                new_printed = os.path.getsize(output_filename)
-                with lock:
-                    queue.put(new_printed - printed)
-                printed = new_printed
-        if buffered:
-            with open(output_filename, "a") as f:
-                f.write(''.join(buffered))
-            new_printed = os.path.getsize(output_filename)
-            with lock:
-                queue.put(new_printed - printed)
+def _init_worker(counters, metrics, next_slot, profile):
+    global _counters, _slot, _metrics, _metrics_offset, _profiler, _profile_file
+    with next_slot.get_lock():
+        _slot = next_slot.value
+        next_slot.value += 1
+    _counters = counters
+    _metrics = metrics
+    _metrics_offset = _slot * len(METRICS)
+    if profile is not None:
+        _profiler = cProfile.Profile()
+        _profile_file = os.path.join(profile, "worker-{0}.prof".format(_slot))
+        Finalize(None, _dump_profile, exitpriority=0)
+
+
+def _dump_profile():
+    _profiler.dump_stats(_profile_file)
+
+
+class WorkerPool:
+    # Long-lived pool shared by the split and merge phases of one or several sorts.
+    # Given a profile directory, every worker dumps cProfile statistics of its tasks to worker-<N>.prof there.
+    def __init__(self, processes=None, profile=None):
+        self.processes = processes or os.cpu_count()
+        self.profile = profile
+        self._counters = Array("q", self.processes, lock=False)
+        self._metrics = Array("q", self.processes * len(METRICS), lock=False)
+        self._pool = Pool(self.processes, initializer=_init_worker,
+                          initargs=(self._counters, self._metrics, Value("i", 0), profile))
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None):
+        return self._pool.apply_async(func, args, callback=callback, error_callback=error_callback)
+
+    def printed(self):
+        return sum(self._counters)
+
+    def metrics(self):
+        # Counters of METRICS of every worker since the pool was created.
+        size = len(METRICS)
+        return [self._metrics[i * size:(i + 1) * size] for i in range(self.processes)]
+
+    def close(self):
+        # Workers of a profiled pool are let exit on their own, so they dump their profiles once.
+        if self.profile is not None:
+            self._pool.close()
+        else:
+            self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self._pool.terminate()
+            self._pool.join()
+            return
+        self.close()
+
+
+@contextmanager
+def use_pool(pool, processes=None, profile=None):
+    # The given pool, or a new one closed on exit.
+    if pool is not None:
+        yield pool
+        return
+    with WorkerPool(processes, profile) as pool:
+        yield pool
+
+
+def _report_printed(size):
+    # Only this worker writes to its slot, so no lock or IPC is needed.
+    if _counters is not None:
+        _counters[_slot] += size
+
+
+def _read_metrics(pool=None):
+    # Counters of the main process and of the pool workers for Statistic.watch.
+    _metrics[_METRIC_INDEX["cpu_ns"]] = int(time.process_time() * 10 ** 9)
+    _update_peak_rss()
+    metrics = {"main": list(_metrics)}
+    if pool is not None:
+        for i, values in enumerate(pool.metrics()):
+            metrics["worker-{0}".format(i)] = values
+    return metrics
 
+
+@_task_metrics()
+def _merge_files(output_filename, files, buffer_size, reverse_order, keep_keys, compression=None, aggregate=None,
+                 head=None, remove_inputs=True, indexed=False):
+    buffer_size = max(buffer_size // (len(files) + 1), _MIN_READ_BUFFER)
+    _add_metric("merges", 1)
+    _add_metric("merge_read_bytes", sum(os.path.getsize(file) for file in files))
+    output_compression = compression if keep_keys else None
+    index = runs.RunIndex() if keep_keys and indexed and compression is None else None
+    with range_open(files, "rb", buffer_size, compression) as iters, \
+            _open_output(output_filename, buffer_size, output_compression) as f:
+        records = _merge_records(map(runs.read_records, iters), reverse_order, aggregate, head)
+        if aggregate == "count" and not keep_keys:
+            records = _count_lines(records)
+        written = _write_merged(f, records, buffer_size, keep_keys, index)
+    # Runs are counted as stored, the output of the sort as written, for it may be a stream.
+    _add_metric("merge_written_bytes", os.path.getsize(output_filename) if keep_keys else written)
+    if index:
+        index.dump(output_filename)
+    if remove_inputs:
+        for file in files:
+            runs.remove_run(file)
+
+
+def _merge_records(iters, reverse_order, aggregate=None, head=None):
+    # Merged records of sorted runs; only the first head of them are read when head is given.
+    records = heapq.merge(*iters, reverse=reverse_order)
+    if aggregate:
+        records = _aggregate(records, aggregate, True, reverse_order)
+    if head is not None:
+        records = itertools.islice(records, head)
+    return records
+
+
+def _write_merged(f, records, buffer_size, keep_keys, index=None):
+    # Returns the count of bytes written.
+    buffered = []
+    current_size = 0
+    written = 0
+    append = buffered.append
+    pack = runs.pack_header
+    for key, line in records:
+        if keep_keys:
+            append(pack(len(key)))
+            append(key)
+            if index:
+                index.add(key, line)
+        append(line)
+        current_size += len(line)
+        if current_size > buffer_size:
+            written += f.write(b''.join(buffered))
+            buffered = []
+            append = buffered.append
+            _report_printed(current_size)
+            current_size = 0
+    if buffered:
+        written += f.write(b''.join(buffered))
+        _report_printed(current_size)
+    return written
+
+
+def _is_before(record, splitter, reverse_order):
+    return splitter < record if reverse_order else record < splitter
+
+
+def _choose_splitters(files, count_of_partitions, reverse_order):
+    # Index entries sample every run, each weighted by the bytes up to the next sample, and splitters are
+    # taken where the weight of the smaller samples reaches an equal share of the data.
+    total_size = sum(os.path.getsize(file) for file in files)
+    stride = max(total_size // (runs.INDEX_STEP * _MAX_SAMPLES), 1)
+    samples = []
     for file in files:
-        os.remove(file)
+        index = runs.load_index(file)
+        if index is None:
+            return None
+        entries, size, _ = index
+        entries = entries[::stride]
+        ends = [offset for _, _, offset, _ in entries[1:]] + [size]
+        samples.extend(((key, line), end - offset) for (key, line, offset, _), end in zip(entries, ends))
+    samples.sort(key=itemgetter(0), reverse=reverse_order)
+    splitters = []
+    weight = 0
+    for sample, sample_weight in samples:
+        if weight * count_of_partitions >= total_size * (len(splitters) + 1):
+            splitters.append(sample)
+            if len(splitters) == count_of_partitions - 1:
+                break
+        weight += sample_weight
+    return splitters
+
+
+def _locate_splitters(filename, splitters, reverse_order):
+    # Offset and bytes of lines before every key range of a run: binary search in the index, then a short scan.
+    entries, size, printed = runs.load_index(filename)
+    positions = [(0, 0)]
+    with open(filename, "rb") as f:
+        for splitter in splitters:
+            left, right = 0, len(entries)
+            while left < right:
+                middle = (left + right) // 2
+                if _is_before(entries[middle][:2], splitter, reverse_order):
+                    left = middle + 1
+                else:
+                    right = middle
+            offset, before = entries[left - 1][2:] if left else (0, 0)
+            f.seek(offset)
+            for record in runs.read_range(f, size - offset):
+                if not _is_before(record, splitter, reverse_order):
+                    break
+                offset += runs.HEADER_SIZE + len(record[0]) + len(record[1])
+                before += len(record[1])
+            positions.append((offset, before))
+    positions.append((size, printed))
+    return positions
+
+
+@_task_metrics()
+def _merge_range(output_filename, output_offset, ranges, buffer_size, reverse_order):
+    # Merges one key range of every run into its own region of the pre-sized output.
+    buffer_size = max(buffer_size // (len(ranges) + 1), _MIN_READ_BUFFER)
+    _add_metric("merges", 1)
+    _add_metric("merge_read_bytes", sum(end - start for _, start, end in ranges))
+    with range_open([file for file, _, _ in ranges], "rb", buffer_size) as iters, \
+            open(output_filename, "r+b", buffer_size) as f:
+        f.seek(output_offset)
+        records = []
+        for file, (_, start, end) in zip(iters, ranges):
+            file.seek(start)
+            records.append(runs.read_range(file, end - start))
+        written = _write_merged(f, heapq.merge(*records, reverse=reverse_order), buffer_size, False)
+    _add_metric("merge_written_bytes", written)
 
 
 def _get_expected_tree_height(count_of_files, to_merge):
@@ -125,72 +980,363 @@ def _get_expected_tree_height(count_of_files, to_merge):
     return ans
 
 
-def merge_files(filename, output_filename, count_of_files, buffer_size, parser, path, reverse_order, statistic=None):
-    to_merge = 20
+def _get_descriptor_limit():
+    if resource is None:
+        return _DEFAULT_DESCRIPTOR_LIMIT
+    soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if soft_limit == resource.RLIM_INFINITY:
+        return _DEFAULT_DESCRIPTOR_LIMIT
+    return soft_limit
+
+
+def _get_fan_in(count_of_files, buffer_size):
+    fan_in = min(count_of_files,
+                 _get_descriptor_limit() - _RESERVED_DESCRIPTORS,
+                 buffer_size // _MIN_READ_BUFFER - 1)
+    return max(fan_in, 2)
+
+
+def _get_group_size(count_of_runs, to_merge, final_to_merge):
+    # Merge only as many runs as needed for the rest to fit in the final pass.
+    excess = count_of_runs - final_to_merge
+    if excess <= 0:
+        return 0
+    return min(to_merge, excess + 1)
+
+
+def __wait_for(worker, pool, printed, statistic):
+    while not worker.ready():
+        worker.wait(_PROGRESS_INTERVAL)
+        printed = __print_statistic(pool, printed, statistic)
+    worker.get()
+    return __print_statistic(pool, printed, statistic)
+
+
+class _MergeScheduler:
+    # Merge DAG driven by completion events: runs are merged as soon as enough of them are ready,
+    # while the split phase is still producing runs and without waiting for the rest of a merge level.
+    def __init__(self, pool, path, buffer_size, reverse_order, compression=None, aggregate=None, head=None,
+                 manifest=None, indexed=False):
+        self.pool = pool
+        self.path = path
+        self.buffer_size = buffer_size
+        self.reverse_order = reverse_order
+        self.compression = compression
+        self.aggregate = aggregate
+        self.head = head
+        # Runs and merges are recorded in the manifest of a resumable sort, which also gives the runs done before.
+        self.manifest = manifest
+        # Merged runs are indexed only for a final merge which can be partitioned.
+        self.indexed = indexed
+        # The count of runs is not known before the split ends, fan-in is limited by memory and descriptors only.
+        self.final_to_merge = _get_fan_in(sys.maxsize, buffer_size)
+        self.to_merge = min(_get_fan_in(sys.maxsize, buffer_size // pool.processes), self.final_to_merge)
+        self.count_of_runs = manifest.count_of_runs if manifest else 0
+        self.count_of_merges = manifest.count_of_merges if manifest else 0
+        self.ready = deque(manifest.ready if manifest else ())
+        self.pending = 0
+        self.printed = pool.printed()
+        self._finished = queue.Queue()
+
+    def add_run(self, name, splitting=True):
+        if self.manifest:
+            self.manifest.add_run(name)
+        self.count_of_runs += 1
+        self.ready.append(name)
+        self.collect()
+        self.schedule(splitting)
+
+    def schedule(self, splitting=False):
+        while True:
+            group_size = _get_group_size(len(self.ready) + self.pending, self.to_merge, self.final_to_merge)
+            # While splitting, more runs are coming, so only full groups are merged early.
+            if not group_size or len(self.ready) < group_size or splitting and group_size < self.to_merge:
+                return
+            group = [self.ready.popleft() for _ in range(group_size)]
+            next_file = os.path.join(self.path, "m" + str(self.count_of_merges))
+            self.count_of_merges += 1
+            # Inputs of a recorded merge are removed only after the merge is in the manifest.
+            self.pool.apply_async(_merge_files,
+                                  args=(next_file, group, self.buffer_size // self.pool.processes, self.reverse_order,
+                                        True, self.compression, self.aggregate, self.head, not self.manifest,
+                                        self.indexed),
+                                  callback=lambda _, name=next_file, group=group: self._finished.put(
+                                      (name, group, None)),
+                                  error_callback=lambda err: self._finished.put((None, None, err)))
+            self.pending += 1
+
+    def collect(self, timeout=None):
+        # Takes finished merges; waits up to timeout for the first one if given.
+        block = timeout is not None
+        while self.pending:
+            try:
+                name, group, err = self._finished.get(block, timeout)
+            except queue.Empty:
+                return
+            if err is not None:
+                raise err
+            if self.manifest:
+                self.manifest.add_merge(name, group)
+                for file in group:
+                    runs.remove_run(file)
+            self.ready.append(name)
+            self.pending -= 1
+            block = False
+
+
+def merge_files(filename, output_filename, count_of_files, buffer_size, path, reverse_order, statistic=None,
+                compression=None, pool=None, aggregate=None):
+    _check_aggregate(aggregate)
+    with use_pool(pool) as pool:
+        scheduler = _MergeScheduler(pool, path, buffer_size, reverse_order, compression, aggregate,
+                                    indexed=_can_partition(output_filename, pool.processes, compression, aggregate))
+        for i in range(count_of_files):
+            scheduler.add_run(os.path.join(path, str(i)), splitting=False)
+        _merge_runs(filename, output_filename, scheduler, statistic)
+
+
+def _merge_runs(filename, output_filename, scheduler, statistic):
+    pool = scheduler.pool
     if statistic:
-        statistic.next_state(os.path.getsize(filename) * _get_expected_tree_height(count_of_files, to_merge))
+        height = 1
+        count_of_files = scheduler.count_of_runs
+        if count_of_files > scheduler.final_to_merge:
+            count_of_files = (count_of_files + scheduler.final_to_merge - 1) // scheduler.final_to_merge
+            height += _get_expected_tree_height(count_of_files, scheduler.to_merge)
+        size = _get_input_size(filename)
+        statistic.next_state(size * height if size is not None else None)
         statistic.print()
-    left = 0
-    right = count_of_files
-    parser = dill.dumps(parser)
-    while right - left != 1:
-        cnt = (right - left) // to_merge + int((right - left) % to_merge != 0)
-        with Pool(maxtasksperchild=1000) as pool:
-            with Manager() as manager:
-                queue = manager.Queue()
-                lock = manager.Lock()
-                workers = []
-                for _ in range(cnt):
-                    next_file = os.path.join(path, str(count_of_files))
-                    count_of_files += 1
-                    workers.append(pool.apply_async(_merge_files,
-                                                    args=(next_file, parser, left, min(left + to_merge, right),
-                                                          buffer_size // os.cpu_count(),
-                                                          path, reverse_order, queue, lock)))
-                    left += to_merge
-                while not all(worker.ready() for worker in workers):
-                    time.sleep(0.1)
-                    __print_statistic(lock, queue, statistic)
-                __print_statistic(lock, queue, statistic)
-        left, right = right, count_of_files
-    last_file = os.path.join(path, str(count_of_files - 1))
-    shutil.copy(last_file, output_filename)
-    os.remove(last_file)
+    printed = scheduler.printed
+    scheduler.schedule()
+    while scheduler.pending:
+        scheduler.collect(_PROGRESS_INTERVAL)
+        scheduler.schedule()
+        printed = __print_statistic(pool, printed, statistic)
+    if output_filename == STREAM:
+        sys.stdout.flush()
+    files = list(scheduler.ready)
+    partitions = _partition_final_merge(output_filename, files, scheduler)
+    if partitions is None:
+        workers = [pool.apply_async(_merge_files, args=(output_filename, files, scheduler.buffer_size,
+                                                        scheduler.reverse_order, False, scheduler.compression,
+                                                        scheduler.aggregate, scheduler.head,
+                                                        not scheduler.manifest))]
+    else:
+        workers = [pool.apply_async(_merge_range, args=(output_filename, output_offset, ranges,
+                                                        scheduler.buffer_size // len(partitions),
+                                                        scheduler.reverse_order))
+                   for output_offset, ranges in partitions]
+    for worker in workers:
+        printed = __wait_for(worker, pool, printed, statistic)
+    if partitions is not None:
+        for file in files:
+            runs.remove_run(file)
     if statistic:
         statistic.print()
 
 
-def __print_statistic(lock, queue, statistic):
-    with lock:
-        cur_sum = 0
-        for _ in range(queue.qsize()):
-            cur_sum += queue.get()
-    if not statistic:
-        return
-    statistic.add_printed(cur_sum)
-    statistic.print()
+def _is_regular_file(filename):
+    # Outputs which are not regular files, e.g. /dev/null or pipes, can be neither truncated nor written at offsets.
+    try:
+        return stat.S_ISREG(os.stat(filename).st_mode)
+    except FileNotFoundError:
+        return True
+
+
+def _can_partition(output_filename, processes, compression, aggregate, head=None):
+    # Runs are indexed only if the final merge may be split among processes by key ranges.
+    return (processes >= 2 and not compression and not aggregate and head is None and output_filename != STREAM
+            and _is_regular_file(output_filename))
+
+
+def _partition_final_merge(output_filename, files, scheduler):
+    # Output offset and run ranges of every worker of a parallel final merge, None if it has to be serial.
+    # Output regions are sized from the runs, which is not known in advance when records are combined or cut.
+    pool = scheduler.pool
+    if not _can_partition(output_filename, pool.processes, scheduler.compression, scheduler.aggregate,
+                          scheduler.head):
+        return None
+    splitters = _choose_splitters(files, pool.processes, scheduler.reverse_order)
+    if splitters is None:
+        return None
+    workers = [pool.apply_async(_locate_splitters, args=(file, splitters, scheduler.reverse_order))
+               for file in files]
+    positions = [worker.get() for worker in workers]
+    partitions = []
+    for i in range(len(splitters) + 1):
+        ranges = [(file, position[i][0], position[i + 1][0])
+                  for file, position in zip(files, positions) if position[i + 1][0] > position[i][0]]
+        partitions.append((sum(position[i][1] for position in positions), ranges))
+    with open(output_filename, "wb") as f:
+        f.truncate(sum(position[-1][1] for position in positions))
+    return partitions
+
+
+def __print_statistic(pool, printed, statistic):
+    total = pool.printed()
+    if statistic and total != printed:
+        statistic.add_printed(total - printed)
+        statistic.print()
+    return total
+
+
+def _split_input(filename, path, reverse_order, parser, memory_usage, statistic, processes, run_formation,
+                 encoding, use_mmap, compression, numeric_columns, input_size, pool, run_callback=None,
+                 aggregate=None, indexed=False):
+    if run_formation == "replacement":
+        return replacement_selection(filename,
+                                     reverse_order=reverse_order,
+                                     parser=parser,
+                                     memory_usage=memory_usage,
+                                     path=path,
+                                     statistic=statistic,
+                                     encoding=encoding,
+                                     compression=compression,
+                                     run_callback=run_callback,
+                                     aggregate=aggregate,
+                                     indexed=indexed)
+    if use_mmap and input_size is not None:
+        return split_file_mmap(filename,
+                               reverse_order=reverse_order,
+                               parser=parser,
+                               memory_usage=memory_usage,
+                               path=path,
+                               statistic=statistic,
+                               encoding=encoding,
+                               compression=compression,
+                               run_callback=run_callback,
+                               aggregate=aggregate,
+                               indexed=indexed)
+    if processes == 1 or input_size is None:
+        loop = asyncio.new_event_loop()
+        try:
+            return split_file(filename,
+                              reverse_order=reverse_order,
+                              parser=parser,
+                              memory_usage=memory_usage,
+                              path=path,
+                              loop=loop,
+                              statistic=statistic,
+                              block_size=_get_block_size(memory_usage, 2),
+                              encoding=encoding,
+                              numeric_columns=numeric_columns,
+                              compression=compression,
+                              run_callback=run_callback,
+                              aggregate=aggregate,
+                              indexed=indexed)
+        finally:
+            loop.close()
+    return split_file_parallel(filename,
+                               reverse_order=reverse_order,
+                               parser=parser,
+                               memory_usage=memory_usage,
+                               path=path,
+                               processes=processes,
+                               statistic=statistic,
+                               block_size=_get_block_size(memory_usage, min(processes, os.cpu_count())),
+                               encoding=encoding,
+                               numeric_columns=numeric_columns,
+                               compression=compression,
+                               pool=pool,
+                               run_callback=run_callback,
+                               aggregate=aggregate,
+                               indexed=indexed)
+
+
+def _get_job(filename, reverse_order, sep, field, types, key_specs, encoding, compression, aggregate):
+    # Everything the runs of a resumable sort depend on; a manifest of another job is not resumed.
+    file_stat = os.stat(filename)
+    return {"input": os.path.abspath(filename), "size": file_stat.st_size, "mtime": file_stat.st_mtime_ns,
+            "reverse_order": reverse_order, "sep": sep, "field": field, "types": types,
+            "key_specs": list(key_specs) if key_specs else None, "encoding": encoding, "compression": compression,
+            "aggregate": aggregate}
 
 
 def out_sort(filename, output_filename, path, reverse_order=False,
              sep=' ', field=1, types="", memory_usage=2 ** 23,
-             statistic=None):
-    time.clock()
+             statistic=None, processes=1, run_formation="blocks", encoding="utf-8", use_mmap=False,
+             compression=None, pool=None, key_specs=None, unique=False, count=False, head=None, resume=False,
+             profile=None):
     if statistic:
+        statistic.watch(partial(_read_metrics, pool))
         statistic.print()
     if field < 1:
         raise ValueError("Incorrect number of field.")
-    parser = lambda line: _split_line(line, sep, field, types)
+    if key_specs:
+        parser = key_spec.compile_keys(key_specs, sep)
+        numeric_columns = None
+    else:
+        parser = key_spec.compile_parser(sep, field, types)
+        numeric_columns = _get_numeric_columns(sep, field, types)
+    if run_formation not in ("blocks", "replacement"):
+        raise ValueError("Unknown run formation {0}.".format(run_formation))
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        raise ValueError("Unknown encoding {0}.".format(encoding))
+    runs.check_compression(compression)
+    if unique and count:
+        raise ValueError("Unique and count modes can not be combined.")
+    aggregate = "count" if count else "unique" if unique else None
     memory_usage //= 2
-    loop = asyncio.get_event_loop()
-    count_of_files = split_file(filename,
-                                reverse_order=reverse_order,
-                                parser=parser,
-                                memory_usage=memory_usage,
-                                path=path,
-                                loop=loop,
-                                statistic=statistic)
-    buffer_size = int(max(2 ** 20, memory_usage))
-    merge_files(filename, output_filename, count_of_files, buffer_size, parser, path, reverse_order, statistic)
+    if head is not None:
+        sort_head(filename, output_filename, head, path,
+                  reverse_order=reverse_order,
+                  parser=parser,
+                  memory_usage=memory_usage,
+                  statistic=statistic,
+                  encoding=encoding,
+                  numeric_columns=numeric_columns,
+                  aggregate=aggregate,
+                  compression=compression,
+                  pool=pool,
+                  profile=profile)
+        if statistic:
+            statistic.next_state(0)
+            statistic.print()
+        return
+    input_size = _get_input_size(filename)
+    if input_size is not None and input_size * _MEMORY_FACTOR <= memory_usage:
+        sort_in_memory(filename, output_filename,
+                       reverse_order=reverse_order,
+                       parser=parser,
+                       statistic=statistic,
+                       encoding=encoding,
+                       numeric_columns=numeric_columns,
+                       aggregate=aggregate)
+        if statistic:
+            statistic.next_state(0)
+            statistic.print()
+        return
+    if resume and input_size is None:
+        raise ValueError("Sorting of a stream can not be resumed.")
+    with use_pool(pool, max(processes, os.cpu_count()), profile) as pool:
+        if statistic:
+            statistic.watch(partial(_read_metrics, pool))
+        manifest = None
+        if resume:
+            path = os.path.join(path, RUNS)
+            os.makedirs(path, exist_ok=True)
+            manifest = Manifest(path, _get_job(filename, reverse_order, sep, field, types, key_specs, encoding,
+                                               compression, aggregate))
+        indexed = _can_partition(output_filename, pool.processes, compression, aggregate)
+        # Runs are handed to the merge scheduler as soon as they are written, so merging overlaps the split.
+        scheduler = _MergeScheduler(pool, path, int(max(2 ** 20, memory_usage)), reverse_order, compression,
+                                    aggregate, manifest=manifest, indexed=indexed)
+        if manifest and manifest.split_done:
+            if statistic:
+                statistic.next_state(input_size)
+                statistic.add_printed(input_size)
+        else:
+            _split_input(filename, path, reverse_order, parser, memory_usage, statistic, processes, run_formation,
+                         encoding, use_mmap, compression, numeric_columns, input_size, pool,
+                         run_callback=scheduler.add_run, aggregate=aggregate, indexed=indexed)
+            if manifest:
+                manifest.finish_split()
+        _merge_runs(filename, output_filename, scheduler, statistic)
+        if manifest:
+            manifest.remove()
+            os.rmdir(path)
     if statistic:
         statistic.next_state(0)
         statistic.print()
@@ -0,0 +1,116 @@
+import gzip
+import lzma
+import os
+import pickle
+import struct
+
+COMPRESSIONS = ("zlib", "lzma")
+_HEADER = struct.Struct(">I")
+_ZLIB_LEVEL = 1
+_LZMA_PRESET = 0
+INDEX_STEP = 2 ** 13
+INDEX_SUFFIX = ".idx"
+pack_header = _HEADER.pack
+HEADER_SIZE = _HEADER.size
+_COUNT = struct.Struct(">Q")
+pack_count = _COUNT.pack
+COUNT_SIZE = _COUNT.size
+
+
+def check_compression(compression):
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError("Unknown compression {0}. Expected one of {1}.".format(compression, ", ".join(COMPRESSIONS)))
+
+
+def compress(data, compression=None):
+    if compression == "zlib":
+        return gzip.compress(data, compresslevel=_ZLIB_LEVEL)
+    if compression == "lzma":
+        return lzma.compress(data, preset=_LZMA_PRESET)
+    return data
+
+
+def open_run(filename, mode, compression=None, buffering=-1):
+    if compression == "zlib":
+        return gzip.GzipFile(filename, mode, compresslevel=_ZLIB_LEVEL)
+    if compression == "lzma":
+        return lzma.LZMAFile(filename, mode, preset=_LZMA_PRESET if "w" in mode else None)
+    return open(filename, mode, buffering)
+
+
+def dump_records(records):
+    return b"".join(pack_header(len(key)) + key + line for key, line in records)
+
+
+def read_records(file):
+    read = file.read
+    readline = file.readline
+    unpack = _HEADER.unpack
+    while True:
+        header = read(_HEADER.size)
+        if not header:
+            return
+        key = read(unpack(header)[0])
+        yield key, readline()
+
+
+def read_range(file, size):
+    # Records of the next size bytes of a run.
+    read = file.read
+    readline = file.readline
+    unpack = _HEADER.unpack
+    while size > 0:
+        header = read(_HEADER.size)
+        if not header:
+            return
+        length = unpack(header)[0]
+        key = read(length)
+        line = readline()
+        size -= _HEADER.size + length + len(line)
+        yield key, line
+
+
+class RunIndex:
+    # Sparse index of an uncompressed run: key, line, offset and bytes of lines before a record every step bytes.
+    def __init__(self, step=INDEX_STEP):
+        self.entries = []
+        self.size = 0
+        self.printed = 0
+        self._next_offset = 0
+        self._step = step
+
+    def add(self, key, line):
+        if self.size >= self._next_offset:
+            self.entries.append((key, line, self.size, self.printed))
+            self._next_offset = self.size + self._step
+        self.size += _HEADER.size + len(key) + len(line)
+        self.printed += len(line)
+
+    def extend(self, records):
+        for key, line in records:
+            self.add(key, line)
+
+    def dump(self, filename):
+        with open(filename + INDEX_SUFFIX, "wb") as f:
+            pickle.dump((self.entries, self.size, self.printed), f, pickle.HIGHEST_PROTOCOL)
+
+
+def load_index(filename):
+    # Entries, size and bytes of lines of an indexed run, None if the run has no index.
+    try:
+        with open(filename + INDEX_SUFFIX, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def remove_run(filename):
+    os.remove(filename)
+    try:
+        os.remove(filename + INDEX_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+
+def unpack_count(data):
+    return _COUNT.unpack(data)[0]
@@ -1,5 +1,14 @@
+import json
+import time
 from enum import IntEnum
 
+# Counters kept for the main process and every worker of a sort. Times are counted in nanoseconds
+# and reported in seconds; peak_rss_bytes is the largest resident set, the others are sums.
+METRICS = ("tasks", "runs", "merges", "lines", "key_ns", "read_bytes", "written_bytes", "merge_read_bytes",
+           "merge_written_bytes", "wall_ns", "cpu_ns", "peak_rss_bytes")
+_PEAKS = ("peak_rss_bytes",)
+_NANOSECONDS = 10 ** 9
+
 
 class State(IntEnum):
     PENDING = 0
@@ -9,25 +18,69 @@ class State(IntEnum):
 
 
 class Statistic:
-    def __init__(self, print_function=None):
+    # With an interval in seconds or a step of the finished part, print passes to the printer only the calls made
+    # that long or that far into the phase after the last printed one, and the first call of every state.
+    def __init__(self, print_function=None, interval=None, step=None):
         self._state = State.PENDING
         self._printed_size = 0
         self._expected_size = 0
         self._printer = print_function
+        self._interval = interval
+        self._step = step
+        self._last_print = None
+        self._metrics = None
+        self._baseline = {}
+        self._phase_start = time.perf_counter()
+        self._phases = {}
 
     @property
     def state(self):
         return self._state
 
+    @property
+    def printed_size(self):
+        return self._printed_size
+
+    @property
+    def expected_size(self):
+        return self._expected_size
+
     def next_state(self, size):
-        if not isinstance(size, int):
+        # None means that the size is unknown, e.g. when sorting a pipe.
+        if size is not None and not isinstance(size, int):
             raise ValueError("Incorrect type of argument. Printed and expected sizes can only be integer.")
         if self._state == State.FINISHED:
             return
+        self._finish_phase()
         self._printed_size = 0
         self._expected_size = size
         self._state = State(self._state.value + 1)
 
+    def watch(self, metrics):
+        # metrics() gives the counters of every process of the sort as {name: values in the order of METRICS}.
+        # Processes seen for the first time are counted from now on.
+        self._metrics = metrics
+        for name, values in metrics().items():
+            self._baseline.setdefault(name, list(values))
+
+    def _finish_phase(self):
+        now = time.perf_counter()
+        workers = {}
+        if self._metrics:
+            current = {name: list(values) for name, values in self._metrics().items()}
+            for name, values in current.items():
+                before = self._baseline.get(name, [0] * len(METRICS))
+                workers[name] = {metric: value if metric in _PEAKS else value - old
+                                 for metric, value, old in zip(METRICS, values, before)}
+            self._baseline = current
+        if self._state != State.PENDING:
+            self._phases[self._state] = {"wall_time": now - self._phase_start, "workers": workers}
+        self._phase_start = now
+
+    @property
+    def phases(self):
+        return dict(self._phases)
+
     def add_printed(self, size):
         if not isinstance(size, int):
             raise ValueError("Incorrect type of argument. Printed and expected sizes can only be integer.")
@@ -35,7 +88,25 @@ class Statistic:
             return
         self._printed_size += size
 
+    @property
+    def throughput(self):
+        # Bytes per second printed in the current state.
+        elapsed = time.perf_counter() - self._phase_start
+        return self._printed_size / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        # Seconds left in the current state at its throughput so far, None if they can not be estimated.
+        if self._state == State.FINISHED:
+            return 0.0
+        throughput = self.throughput
+        if self._state == State.PENDING or self._expected_size is None or not throughput:
+            return None
+        return max(self._expected_size - self._printed_size, 0) / throughput
+
     def get_finished_part(self):
+        if self._expected_size is None and self._state != State.FINISHED:
+            return 0
         if not self._expected_size or self._state == State.FINISHED:
             return 1
         part = self._printed_size / self._expected_size
@@ -46,5 +117,59 @@ class Statistic:
             .format(self._state.name, self._printed_size, self._expected_size)
 
     def print(self):
-        if self._printer:
+        if self._printer and self._is_due():
             self._printer(self)
+
+    def _is_due(self):
+        if self._interval is None and self._step is None:
+            return True
+        now = time.perf_counter()
+        part = self.get_finished_part()
+        if self._last_print is not None:
+            state, last_time, last_part = self._last_print
+            if state == self._state and (self._interval is None or now - last_time < self._interval) \
+                    and (self._step is None or part - last_part < self._step):
+                return False
+        self._last_print = self._state, now, part
+        return True
+
+    def report(self):
+        # Finished phases with their wall time and the counters of every process, and merge passes over the runs.
+        phases = {}
+        written = 0
+        merge_read = 0
+        for state, phase in sorted(self._phases.items()):
+            workers = {}
+            for name, values in phase["workers"].items():
+                workers[name] = {_report_name(metric): value / _NANOSECONDS if metric.endswith("_ns") else value
+                                 for metric, value in values.items()}
+                written += values["written_bytes"]
+                merge_read += values["merge_read_bytes"]
+            phases[state.name.lower()] = {"wall_time": phase["wall_time"], "workers": workers}
+        return {"phases": phases, "merge_passes": merge_read / written if written else 0.0}
+
+    def to_json(self):
+        return json.dumps(self.report(), indent=2, sort_keys=True)
+
+    def to_prometheus(self, prefix="out_sort"):
+        # Text exposition format: one gauge per counter, labelled by phase and process.
+        report = self.report()
+        samples = {"phase_wall_seconds": [({"phase": phase}, data["wall_time"])
+                                          for phase, data in report["phases"].items()]}
+        for phase, data in report["phases"].items():
+            for worker, values in data["workers"].items():
+                for metric, value in values.items():
+                    samples.setdefault("worker_" + metric, []).append(({"phase": phase, "worker": worker}, value))
+        samples["merge_passes"] = [({}, report["merge_passes"])]
+        lines = []
+        for metric, values in samples.items():
+            name = "{0}_{1}".format(prefix, metric)
+            lines.append("# TYPE {0} gauge".format(name))
+            for labels, value in values:
+                labels = ",".join('{0}="{1}"'.format(key, label) for key, label in labels.items())
+                lines.append("{0}{1} {2}".format(name, "{" + labels + "}" if labels else "", value))
+        return "\n".join(lines) + "\n"
+
+
+def _report_name(metric):
+    return metric[:-len("_ns")] + "_seconds" if metric.endswith("_ns") else metric
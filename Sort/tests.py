@@ -1,11 +1,36 @@
 import asyncio
+import collections
+import io
+import json
 import os
+import pickle
+import pstats
+import random
 import tempfile
+import tracemalloc
 import unittest
-from out_sort.sort_statistic import State
+from operator import itemgetter
+from out_sort.sort_statistic import METRICS, State
 from out_sort.sort_statistic import Statistic
 import out_sort.out_sort as out_sort
-from utils import file_generator
+from out_sort import iter_sort, key_spec, keys, manifest, runs
+from utils import benchmark, file_generator, verifier
+
+
+def make_run(filename, parser, reverse_order=False):
+    with open(filename, "rb") as f:
+        records = out_sort._make_records([line.rstrip(b"\n") for line in f], parser)
+    records.sort(reverse=reverse_order)
+    with open(filename, "wb") as f:
+        f.write(runs.dump_records(records))
+
+
+def check_run(filename, reverse_order, compression=None):
+    with runs.open_run(filename, "rb", compression) as f:
+        records = list(runs.read_records(f))
+    if records != sorted(records, reverse=reverse_order):
+        return 0
+    return len(records)
 
 
 class StatisticTest(unittest.TestCase):
@@ -51,6 +76,17 @@ class StatisticTest(unittest.TestCase):
         stat.add_printed(10)
         self.assertEqual(0, stat._printed_size)
 
+    def test_unknown_size(self):
+        stat = Statistic(None)
+        stat.next_state(None)
+        self.assertIsNone(stat.expected_size)
+        stat.add_printed(10)
+        self.assertEqual(10, stat.printed_size)
+        self.assertEqual(0, stat.get_finished_part())
+        stat.next_state(None)
+        stat.next_state(None)
+        self.assertEqual(1, stat.get_finished_part())
+
     def test_get_finished_part(self):
         stat = Statistic(None)
         self.assertAlmostEqual(1, stat.get_finished_part(), delta=10 ** (-5))
@@ -60,6 +96,60 @@ class StatisticTest(unittest.TestCase):
             stat.add_printed(1)
         self.assertAlmostEqual(1, stat.get_finished_part(), delta=10 ** (-5))
 
+    def test_throttled_print(self):
+        printed = []
+        stat = Statistic(lambda current: printed.append((current.state, current.printed_size)), interval=3600)
+        stat.print()
+        stat.next_state(100)
+        for _ in range(100):
+            stat.add_printed(1)
+            stat.print()
+        stat.next_state(0)
+        stat.print()
+        self.assertEqual([(State.PENDING, 0), (State.SPLITTING, 1), (State.MERGING, 0)], printed)
+        printed.clear()
+        stat = Statistic(lambda current: printed.append(current.printed_size), step=0.25)
+        stat.next_state(100)
+        for _ in range(100):
+            stat.add_printed(1)
+            stat.print()
+        self.assertEqual([1, 26, 51, 76], printed)
+
+    def test_eta(self):
+        stat = Statistic(None)
+        self.assertIsNone(stat.eta)
+        stat.next_state(100)
+        self.assertIsNone(stat.eta)
+        stat.add_printed(25)
+        self.assertGreater(stat.throughput, 0)
+        self.assertAlmostEqual(75 / stat.throughput, stat.eta, delta=0.1)
+        stat.next_state(None)
+        stat.add_printed(25)
+        self.assertIsNone(stat.eta)
+        stat.next_state(0)
+        self.assertEqual(0, stat.eta)
+
+    def test_metrics(self):
+        counters = {"main": [0] * len(METRICS)}
+        stat = Statistic(None)
+        stat.watch(lambda: counters)
+        counters["main"] = [1] * len(METRICS)
+        stat.next_state(10)
+        counters["main"] = [3] * len(METRICS)
+        counters["worker-0"] = [2] * len(METRICS)
+        stat.next_state(10)
+        self.assertEqual([State.SPLITTING], list(stat.phases))
+        workers = stat.phases[State.SPLITTING]["workers"]
+        # Peaks are taken as they are, other counters as differences from the start of the phase.
+        self.assertEqual(dict(dict.fromkeys(METRICS, 2), peak_rss_bytes=3), workers["main"])
+        self.assertEqual(2, workers["worker-0"]["tasks"])
+        report = stat.report()
+        self.assertEqual(["splitting"], list(report["phases"]))
+        self.assertAlmostEqual(2e-9, report["phases"]["splitting"]["workers"]["main"]["key_seconds"])
+        self.assertEqual(1, report["merge_passes"])
+        self.assertEqual(report, json.loads(stat.to_json()))
+        self.assertIn('out_sort_worker_lines{phase="splitting",worker="worker-0"} 2\n', stat.to_prometheus())
+
 
 class SplitLineTest(unittest.TestCase):
     def set_parser(self, sep=' ', field=1, types=''):
@@ -99,6 +189,157 @@ class SplitLineTest(unittest.TestCase):
         self.assertRaises(ValueError, self.parser, "a b")
 
 
+class EncodeFieldsTest(unittest.TestCase):
+    def test_integers(self):
+        values = [0, 1, -1, 255, 256, -256, 2 ** 63 - 1, 2 ** 63, -2 ** 63, -2 ** 63 - 1, 10 ** 40, -10 ** 40, -2 ** 70]
+        self.assertEqual(sorted(values), sorted(values, key=keys.encode_integer))
+        self.assertRaises(ValueError, keys.encode_integer, 2 ** 2048)
+
+    def test_fields(self):
+        rows = [[], ["a"], ["a", 1], ["a", -1], ["ab"], ["a\x00"], ["a\x00", 2], ["b", 0], [""], ["\u044f"], ["z"]]
+        self.assertEqual(sorted(rows), sorted(rows, key=keys.encode_fields))
+        self.assertRaises(ValueError, keys.encode_fields, [None])
+
+    def test_floats(self):
+        values = [0.0, -0.0, 1.5, -1.5, 1e300, -1e300, 5e-324, -5e-324, float("inf"), float("-inf"), 3.0, 2.5]
+        self.assertEqual(sorted(values), sorted(values, key=keys.encode_float))
+        self.assertEqual(keys.encode_float(0.0), keys.encode_float(-0.0))
+
+    def test_reversed(self):
+        rows = [["a"], ["ab"], ["a\x00"], [""], [1], [-1], [2 ** 70], [-2 ** 70], [0.5], [-0.5]]
+        encoded = [keys.encode_fields(row) for row in rows]
+        self.assertEqual(sorted(encoded, reverse=True), sorted(encoded, key=keys.encode_reversed))
+
+
+class KeySpecTest(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual((2, int, True, False), key_spec.parse_key("2nr"))
+        self.assertEqual((1, str, False, True), key_spec.parse_key("1f"))
+        self.assertEqual((3, float, False, False), key_spec.parse_key("3g"))
+        for spec in ("", "0", "n", "1x", "1ng", "-1"):
+            self.assertRaises(ValueError, key_spec.parse_key, spec)
+
+    def test_order(self):
+        lines = ["b 10 1.5", "B 2 -1", "a 10 2", "c 2 1e3", "a 2 0.25", "A 10 2"]
+        parser = key_spec.compile_keys(["2nr", "1f", "3g"])
+        expected = sorted(lines, key=lambda line: (-int(line.split()[1]), line.split()[0].lower(),
+                                                   float(line.split()[2]), line))
+        self.assertEqual(expected, sorted(lines, key=lambda line: (keys.encode_fields(parser(line)[0]), line)))
+        self.assertRaises(ValueError, parser, "a b 1")
+        self.assertRaises(ValueError, parser, "a 1")
+
+    def test_compiled_fields(self):
+        lines = ["a 12 b", "  7   x  3 ", "1 2", "q"]
+        for sep, field, types in ((" ", 1, ""), (" ", 2, "nsn"), (" ", 1, "sn"), ("...", 1, "n")):
+            parser = key_spec.compile_parser(sep, field, types)
+            for line in lines:
+                try:
+                    expected = out_sort._split_line(line, sep, field, types)
+                except ValueError:
+                    self.assertRaises(ValueError, parser, line)
+                else:
+                    self.assertEqual(expected, parser(line))
+        self.assertRaises(ValueError, key_spec.compile_parser, " ", 0)
+
+    def test_pickle(self):
+        parser = key_spec.compile_parser(" ", 2, "nn")
+        self.assertIs(parser, pickle.loads(pickle.dumps(parser)))
+        self.assertIs(parser, out_sort.dump_parser(parser))
+        self.assertIsInstance(out_sort.dump_parser(lambda line: ([line], line)), bytes)
+
+    def test_out_sort(self):
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, "input")
+            file_generator.generate_random_file(2 ** 16, filename, "sn")
+            for memory_usage in (2 ** 23, 2 ** 17):
+                out_sort.out_sort(filename, filename + ".sorted", path, memory_usage=memory_usage,
+                                  key_specs=["2nr", "1"])
+                with open(filename) as f:
+                    lines = [line for line in f.read().split("\n") if line]
+                lines.sort(key=lambda line: (-int(line.split()[1]), line.split()[0], line))
+                with open(filename + ".sorted") as f:
+                    self.assertEqual(lines, f.read().split("\n")[:-1])
+
+
+class ManifestTest(unittest.TestCase):
+    def test_replay(self):
+        with tempfile.TemporaryDirectory() as path:
+            job = {"input": "a"}
+            log = manifest.Manifest(path, job)
+            for name in ("0", "1", "2", "m0", "m1"):
+                open(os.path.join(path, name), "w").close()
+                if name.isdigit():
+                    log.add_run(os.path.join(path, name))
+            log.finish_split()
+            log.add_merge(os.path.join(path, "m0"), [os.path.join(path, "0"), os.path.join(path, "1")])
+            log._file.close()
+            with open(os.path.join(path, manifest.MANIFEST), "a") as f:
+                f.write('{"merge": "m1", "inp')
+            resumed = manifest.Manifest(path, job)
+            self.assertTrue(resumed.split_done)
+            self.assertEqual([os.path.join(path, "2"), os.path.join(path, "m0")], resumed.ready)
+            self.assertEqual((3, 1), (resumed.count_of_runs, resumed.count_of_merges))
+            self.assertEqual(["2", "m0", manifest.MANIFEST], sorted(os.listdir(path)))
+            resumed.remove()
+            restarted = manifest.Manifest(path, {"input": "b"})
+            self.assertFalse(restarted.split_done)
+            self.assertEqual([], restarted.ready)
+            restarted.remove()
+            self.assertEqual([], os.listdir(path))
+
+
+class RunsTest(unittest.TestCase):
+    def test_compression(self):
+        records = [(keys.encode_fields(["a", i]), b"a " + str(i).encode() + b"\n") for i in range(1000)]
+        with tempfile.TemporaryDirectory() as tempdir:
+            filename = os.path.join(tempdir, "run")
+            for compression in (None, "zlib", "lzma"):
+                with open(filename, "wb") as f:
+                    f.write(runs.compress(runs.dump_records(records[:500]), compression))
+                    f.write(runs.compress(runs.dump_records(records[500:]), compression))
+                with runs.open_run(filename, "rb", compression) as f:
+                    self.assertEqual(records, list(runs.read_records(f)))
+                with runs.open_run(filename, "wb", compression) as f:
+                    f.write(runs.dump_records(records))
+                with runs.open_run(filename, "rb", compression) as f:
+                    self.assertEqual(records, list(runs.read_records(f)))
+        self.assertRaises(ValueError, runs.check_compression, "bz2")
+
+    def test_merge(self):
+        parser = lambda line: out_sort._split_line(line)
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, "input")
+            lines = file_generator.generate_random_file(2 ** 20, filename)
+            for compression in ("zlib", "lzma"):
+                loop = asyncio.new_event_loop()
+                count_of_files = out_sort.split_file(filename, False, parser, 10 ** 6, path, loop,
+                                                     compression=compression)
+                loop.close()
+                self.assertTrue(check_run(os.path.join(path, "0"), False, compression))
+                with runs.open_run(os.path.join(path, "0"), "rb", compression) as f:
+                    size = len(runs.dump_records(runs.read_records(f)))
+                self.assertLess(os.path.getsize(os.path.join(path, "0")), size)
+                output_filename = os.path.join(path, "output")
+                out_sort.merge_files(filename, output_filename, count_of_files, 2 ** 14, path, False,
+                                     compression=compression)
+                self.assertEqual(lines, file_generator.check_file(output_filename, parser, False))
+
+
+class InputSizeTest(unittest.TestCase):
+    def test(self):
+        self.assertIsNone(out_sort._get_input_size(out_sort.STREAM))
+        self.assertIsNone(out_sort._get_input_size(""))
+        with tempfile.TemporaryDirectory() as tempdir:
+            filename = os.path.join(tempdir, "file")
+            with open(filename, "w") as f:
+                f.write("abc\n")
+            self.assertEqual(4, out_sort._get_input_size(filename))
+            self.assertIsNone(out_sort._get_input_size(tempdir))
+            fifo = os.path.join(tempdir, "fifo")
+            os.mkfifo(fifo)
+            self.assertIsNone(out_sort._get_input_size(fifo))
+
+
 class RangeOpenTest(unittest.TestCase):
     def test(self):
         with tempfile.TemporaryDirectory() as tempdir:
@@ -121,6 +362,75 @@ class ExpectedTreeHeightTest(unittest.TestCase):
         self.assertEqual(3, out_sort._get_expected_tree_height(122, 11))
 
 
+class FanInTest(unittest.TestCase):
+    def test_fan_in(self):
+        self.assertEqual(2, out_sort._get_fan_in(1, 2 ** 20))
+        self.assertEqual(40, out_sort._get_fan_in(40, 2 ** 20))
+        self.assertEqual(3, out_sort._get_fan_in(40, 2 ** 14))
+        self.assertEqual(2, out_sort._get_fan_in(40, 0))
+        self.assertGreaterEqual(out_sort._get_descriptor_limit() - out_sort._RESERVED_DESCRIPTORS,
+                                out_sort._get_fan_in(10 ** 9, 2 ** 40))
+
+    def test_group_size(self):
+        self.assertEqual(0, out_sort._get_group_size(20, 20, 20))
+        self.assertEqual(6, out_sort._get_group_size(25, 20, 20))
+        self.assertEqual(4, out_sort._get_group_size(25, 4, 4))
+        self.assertEqual(2, out_sort._get_group_size(5, 4, 4))
+
+
+class ReadBlocksTest(unittest.TestCase):
+    def test_lines(self):
+        data = b"a\nbb\n\nccc\n" + b"d" * 100 + b"\ne"
+        for block_size in (1, 3, 16, 1000):
+            lines = []
+            for block in out_sort._read_blocks(io.BytesIO(data), block_size):
+                lines.extend(block)
+            self.assertEqual([line for line in data.split(b"\n") if line], [line for line in lines if line])
+
+    def test_records(self):
+        records = out_sort._make_records(["b 2".encode("cp1251"), b"", "\u044f 1".encode("cp1251")],
+                                         lambda line: out_sort._split_line(line, types="sn"), "cp1251")
+        self.assertEqual([(keys.encode_fields(["b", 2]), "b 2\n".encode("cp1251")),
+                          (keys.encode_fields(["\u044f", 1]), "\u044f 1\n".encode("cp1251"))], records)
+
+
+@unittest.skipIf(out_sort.np is None, "numpy is not installed")
+class NumericRecordsTest(unittest.TestCase):
+    def check(self, lines, sep=" ", types="nn", field=1):
+        parser = lambda line: out_sort._split_line(line, sep, field, types)
+        for reverse_order in (False, True):
+            records = out_sort._make_records(lines, parser)
+            records.sort(reverse=reverse_order)
+            self.assertEqual(records, out_sort._numeric_records(lines, (sep, field, len(types)), reverse_order,
+                                                                "utf-8"))
+
+    def test_numeric(self):
+        lines = [b"3  -1", b"3 -1", b"-7 2", b"+3 -1", b"0 0", b"3 -1", b"-9223372036854775 1", b"12 5"]
+        self.check(lines)
+        self.check([line.replace(b" ", b",") for line in lines], sep=",")
+        self.check([b"5"] * 10 + [b"4", b"6"], types="n")
+
+    def test_other_fields(self):
+        lines = [b"1700000123 GET /index 200", b"1700000122 GET /b 404", b"1700000123 POST /index 200",
+                 b"1700000123 GET /index 200", b"1700000123 GET \xd0\xb0 500", b"-5 x", b"7"]
+        self.check(lines, types="n")
+        self.check([b"a 3 4 z", b"b 3 4", b"c -1 9 q", b"a 3 4 y"], types="nn", field=2)
+        self.check([b"GET 17", b"POST 5", b"GET 5"], types="n", field=2)
+
+    def test_not_applicable(self):
+        self.assertIsNone(out_sort._numeric_records([b"1 a"], (" ", 1, 2), False, "utf-8"))
+        self.assertIsNone(out_sort._numeric_records([b"1\t2"], (" ", 1, 2), False, "utf-8"))
+        self.assertIsNone(out_sort._numeric_records([b"1-2 3"], (" ", 1, 2), False, "utf-8"))
+        self.assertIsNone(out_sort._numeric_records([b"1 2"], ("-", 1, 2), False, "utf-8"))
+        self.assertIsNone(out_sort._numeric_records([b"1 10000000000000000000"], (" ", 1, 2), False, "utf-8"))
+        self.assertIsNone(out_sort._numeric_records([b"a 1", b"b"], (" ", 2, 1), False, "utf-8"))
+        self.assertIsNone(out_sort._numeric_records([b"1 a\x00"], (" ", 1, 1), False, "utf-8"))
+        self.assertIsNone(out_sort._numeric_records([b"1 \xff"], (" ", 1, 1), False, "utf-8"))
+        self.assertIsNone(out_sort._numeric_records([b"1 a"], (" ", 1, 1), False, "latin-1"))
+        self.assertIsNone(out_sort._get_numeric_columns(" ", 1, "ns"))
+        self.assertEqual((" ", 2, 2), out_sort._get_numeric_columns(" ", 2, "nn"))
+
+
 class SplitFileTest(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -163,7 +473,7 @@ class SplitFileTest(unittest.TestCase):
             current = os.path.join(path, str(i))
             if not os.path.exists(current):
                 continue
-            if not file_generator.check_file(current, SplitFileTest.parser, reverse_order):
+            if not check_run(current, reverse_order):
                 return False
         return True
 
@@ -174,6 +484,445 @@ class SplitFileTest(unittest.TestCase):
         self.assertTrue(SplitFileTest.checker(True, SplitFileTest.rev_path))
 
 
+class SplitFileParallelTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.TemporaryDirectory()
+        cls.path = cls.dir.name
+        cls.filename = os.path.join(cls.path, "test_input")
+        cls.lines = file_generator.generate_random_file(2 ** 20, cls.filename)
+        cls.parser = lambda line: out_sort._split_line(line)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dir.cleanup()
+
+    def split(self, reverse_order):
+        path = tempfile.mkdtemp(dir=SplitFileParallelTest.path)
+        count_of_files = out_sort.split_file_parallel(SplitFileParallelTest.filename,
+                                                      reverse_order=reverse_order,
+                                                      parser=SplitFileParallelTest.parser,
+                                                      memory_usage=10 ** 6,
+                                                      path=path,
+                                                      processes=4)
+        return path, count_of_files
+
+    def test_blocks(self):
+        blocks = list(out_sort.get_blocks(SplitFileParallelTest.filename, 2 ** 16))
+        self.assertEqual(2 ** 4, len(blocks))
+        self.assertEqual(os.path.getsize(SplitFileParallelTest.filename), sum(length for _, length in blocks))
+
+    def test_bounded_map(self):
+        read = []
+        tasks = ((i, i) for i in range(20) if not read.append(i))
+        with out_sort.WorkerPool(2) as pool:
+            for i, result in enumerate(out_sort.bounded_map(pool, pow, tasks, 3)):
+                self.assertEqual(i ** i, result)
+                # Only the tasks of the window are read ahead of the result taken.
+                self.assertLessEqual(len(read), i + 3)
+
+    def test_sorted(self):
+        for reverse_order in (False, True):
+            path, count_of_files = self.split(reverse_order)
+            self.assertEqual(2 ** 4, count_of_files)
+            lines = 0
+            for i in range(count_of_files):
+                result = check_run(os.path.join(path, str(i)), reverse_order)
+                self.assertNotEqual(0, result)
+                lines += result
+            self.assertEqual(SplitFileParallelTest.lines, lines)
+
+
+class SplitFileMmapTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.TemporaryDirectory()
+        cls.path = cls.dir.name
+        cls.filename = os.path.join(cls.path, "test_input")
+        cls.lines = file_generator.generate_random_file(2 ** 20, cls.filename, "nsn")
+        with open(cls.filename, "a") as f:
+            for _ in range(100):
+                f.write("1    a    1\n")
+        cls.lines += 100
+        cls.parser = lambda line: out_sort._split_line(line, types="n")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dir.cleanup()
+
+    def test_sorted(self):
+        for reverse_order in (False, True):
+            path = tempfile.mkdtemp(dir=SplitFileMmapTest.path)
+            count_of_files = out_sort.split_file_mmap(SplitFileMmapTest.filename,
+                                                      reverse_order=reverse_order,
+                                                      parser=SplitFileMmapTest.parser,
+                                                      memory_usage=2 ** 20,
+                                                      path=path)
+            self.assertGreater(count_of_files, 1)
+            lines = 0
+            for i in range(count_of_files):
+                result = check_run(os.path.join(path, str(i)), reverse_order)
+                self.assertNotEqual(0, result)
+                lines += result
+            self.assertEqual(SplitFileMmapTest.lines, lines)
+
+    def test_empty(self):
+        filename = os.path.join(SplitFileMmapTest.path, "empty")
+        open(filename, "w").close()
+        path = tempfile.mkdtemp(dir=SplitFileMmapTest.path)
+        self.assertEqual(1, out_sort.split_file_mmap(filename, False, SplitFileMmapTest.parser, 2 ** 20, path))
+        self.assertEqual(0, os.path.getsize(os.path.join(path, "0")))
+
+    def test_zero_memory(self):
+        filename = os.path.join(SplitFileMmapTest.path, "small")
+        with open(filename, "w") as f:
+            f.write("3\n\n1\n2\n")
+        path = tempfile.mkdtemp(dir=SplitFileMmapTest.path)
+        self.assertEqual(3, out_sort.split_file_mmap(filename, False, SplitFileMmapTest.parser, 0, path))
+        self.assertEqual([1, 1, 1], [check_run(os.path.join(path, str(i)), False) for i in range(3)])
+
+
+class ReplacementSelectionTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.TemporaryDirectory()
+        cls.path = cls.dir.name
+        cls.filename = os.path.join(cls.path, "test_input")
+        cls.lines = file_generator.generate_random_file(2 ** 20, cls.filename)
+        cls.parser = lambda line: out_sort._split_line(line)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dir.cleanup()
+
+    def select(self, filename, reverse_order):
+        path = tempfile.mkdtemp(dir=ReplacementSelectionTest.path)
+        count_of_files = out_sort.replacement_selection(filename,
+                                                        reverse_order=reverse_order,
+                                                        parser=ReplacementSelectionTest.parser,
+                                                        memory_usage=2 ** 20,
+                                                        path=path)
+        lines = 0
+        for i in range(count_of_files):
+            result = check_run(os.path.join(path, str(i)), reverse_order)
+            self.assertNotEqual(0, result)
+            lines += result
+        return count_of_files, lines
+
+    def test_sorted(self):
+        for reverse_order in (False, True):
+            count_of_files, lines = self.select(ReplacementSelectionTest.filename, reverse_order)
+            self.assertEqual(ReplacementSelectionTest.lines, lines)
+            self.assertLessEqual(count_of_files, 3)
+
+    def test_sorted_input(self):
+        filename = os.path.join(ReplacementSelectionTest.path, "sorted_input")
+        file_generator.generate_file(2 ** 20, filename)
+        self.assertEqual(1, self.select(filename, False)[0])
+
+    def test_block_size(self):
+        self.assertEqual(2 ** 16, out_sort._get_block_size(2 ** 10, 2))
+        self.assertEqual(2 ** 20, out_sort._get_block_size(2 ** 23, 2))
+
+
+class IterSortTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = self.dir.name
+        self.lines = []
+        for i in range(5000):
+            self.lines.append(file_generator.generate_random_string(3) + " " + str(i))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_in_memory(self):
+        result = iter_sort.iter_sort(iter(self.lines), path=self.path)
+        self.assertEqual(sorted(self.lines), list(result))
+        self.assertEqual([], os.listdir(self.path))
+
+    def test_spilled(self):
+        for compression in (None, "zlib"):
+            result = iter_sort.iter_sort(iter(self.lines), reverse_order=True, memory_usage=2 ** 14,
+                                         path=self.path, compression=compression)
+            self.assertEqual(next(result), max(self.lines))
+            self.assertEqual(1, len(os.listdir(self.path)))
+            # Runs are merged down to the fan-in the memory usage allows before the final merge.
+            self.assertLessEqual(len(os.listdir(os.path.join(self.path, os.listdir(self.path)[0]))), 3)
+            self.assertEqual(sorted(self.lines, reverse=True)[1:], list(result))
+            self.assertEqual([], os.listdir(self.path))
+
+    def test_key(self):
+        records = [(line[:1], i) for i, line in enumerate(self.lines)]
+        result = iter_sort.iter_sort(records, key=itemgetter(0), memory_usage=2 ** 14, path=self.path)
+        self.assertEqual(sorted(records, key=itemgetter(0)), list(result))
+        result = iter_sort.iter_sort(records, key=itemgetter(0), memory_usage=2 ** 14, path=self.path)
+        next(result)
+        result.close()
+        self.assertEqual([], os.listdir(self.path))
+        self.assertRaises(ValueError, iter_sort.iter_sort, records, memory_usage=-1)
+
+    def test_memory(self):
+        rng = random.Random(0)
+        items = ("%08d" % rng.randrange(10 ** 8) * 1000 for _ in range(4000))
+        tracemalloc.start()
+        try:
+            result = iter_sort.iter_sort(items, memory_usage=2 ** 20, path=self.path)
+            self.assertEqual(4000, sum(1 for _ in result))
+            # The merge of 32 MB of items holds a chunk of every run, not the runs.
+            self.assertLess(tracemalloc.get_traced_memory()[1], 2 ** 21)
+        finally:
+            tracemalloc.stop()
+
+    def test_chunks(self):
+        filename = os.path.join(self.path, "run")
+        records = [(i, "x" * 8000) for i in range(100)]
+        iter_sort._spill(records, filename, True, 2 ** 20, None)
+        chunk_memory = iter_sort._get_run_memory(2 ** 20)[0]
+        chunks = []
+        with open(filename, "rb") as f:
+            while f.tell() < os.path.getsize(filename):
+                chunks.append(pickle.load(f))
+        self.assertGreater(len(chunks), 10)
+        self.assertEqual(records, [record for chunk in chunks for record in chunk])
+        for chunk in chunks:
+            self.assertLess(sum(iter_sort._get_record_size(record, True) for record in chunk[:-1]), chunk_memory)
+
+    def test_size(self):
+        self.assertGreater(iter_sort._get_size(("a" * 1000, "b" * 1000)), 2000)
+        self.assertGreater(iter_sort._get_size({"a": "b" * 1000}), 1000)
+        # Items are measured with their elements; shallow sizes of these records would fit in memory usage.
+        records = [(str(i) * 200, i) for i in range(2000)]
+        result = iter_sort.iter_sort(iter(records), key=itemgetter(1), reverse_order=True, memory_usage=2 ** 20,
+                                     path=self.path)
+        self.assertEqual(records[-1], next(result))
+        self.assertEqual(1, len(os.listdir(self.path)))
+        self.assertEqual(records[::-1][1:], list(result))
+
+
+class OutSortTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = self.dir.name
+        self.filename = os.path.join(self.path, "input")
+        self.output_filename = os.path.join(self.path, "output")
+        self.workdir = os.path.join(self.path, "work")
+        os.mkdir(self.workdir)
+        self.lines = file_generator.generate_random_file(2 ** 18, self.filename, "nsn")
+        self.parser = lambda line: out_sort._split_line(line, types="nsn")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def check_output(self, reverse_order=False, parser=None):
+        parser = parser or self.parser
+        self.assertEqual(self.lines, file_generator.check_file(self.output_filename, parser, reverse_order))
+
+    def test_in_memory(self):
+        stat = Statistic(None)
+        out_sort.out_sort(self.filename, self.output_filename, self.workdir, types="nsn",
+                          memory_usage=2 ** 23, statistic=stat)
+        self.check_output()
+        self.assertEqual(State.FINISHED, stat.state)
+        self.assertEqual([], os.listdir(self.workdir))
+
+    def test_shared_pool(self):
+        with out_sort.WorkerPool(2) as pool:
+            for reverse_order in (False, True):
+                out_sort.out_sort(self.filename, self.output_filename, self.workdir, types="nsn",
+                                  reverse_order=reverse_order, memory_usage=2 ** 19, processes=2, pool=pool)
+                self.check_output(reverse_order=reverse_order)
+            self.assertGreater(pool.printed(), 0)
+
+    def test_unique_and_count(self):
+        pairs = [(random.randint(-20, 20), random.randint(0, 20)) for _ in range(2 ** 15)]
+        with open(self.filename, "w") as f:
+            f.write("".join("{0} {1}\n".format(*pair) for pair in pairs))
+        counts = collections.Counter(pairs)
+        for memory_usage in (2 ** 23, 2 ** 17):
+            out_sort.out_sort(self.filename, self.output_filename, self.workdir, types="nn",
+                              memory_usage=memory_usage, unique=True)
+            with open(self.output_filename) as f:
+                self.assertEqual(["{0} {1}\n".format(*pair) for pair in sorted(counts)], f.readlines())
+            out_sort.out_sort(self.filename, self.output_filename, self.workdir, types="nn", reverse_order=True,
+                              memory_usage=memory_usage, count=True, run_formation="replacement")
+            with open(self.output_filename) as f:
+                self.assertEqual(["{0} {1} {2}\n".format(counts[pair], *pair) for pair in sorted(counts, reverse=True)],
+                                 f.readlines())
+            self.assertEqual([], os.listdir(self.workdir))
+        self.assertRaises(ValueError, out_sort.out_sort, self.filename, self.output_filename, self.workdir,
+                          unique=True, count=True)
+
+    def test_metrics(self):
+        with tempfile.TemporaryDirectory() as path, out_sort.WorkerPool(2) as pool:
+            for processes in (1, 2):
+                stat = Statistic()
+                out_sort.out_sort(self.filename, self.output_filename, path, types="nsn", memory_usage=2 ** 17,
+                                  statistic=stat, processes=processes, pool=pool)
+                phases = stat.report()["phases"]
+                splitting = phases["splitting"]["workers"].values()
+                self.assertEqual(self.lines, sum(worker["lines"] for worker in splitting))
+                self.assertEqual(os.path.getsize(self.filename), sum(worker["read_bytes"] for worker in splitting))
+                self.assertGreater(sum(worker["runs"] for worker in splitting), 1)
+                merging = phases["merging"]["workers"].values()
+                self.assertEqual(os.path.getsize(self.output_filename),
+                                 sum(worker["merge_written_bytes"] for worker in merging))
+                self.assertGreaterEqual(stat.report()["merge_passes"], 1)
+
+    def test_head(self):
+        out_sort.out_sort(self.filename, self.output_filename, self.workdir, types="nsn", memory_usage=2 ** 23)
+        with open(self.output_filename) as f:
+            expected = f.readlines()
+        for head, memory_usage in ((100, 2 ** 23), (10 ** 4, 2 ** 17), (0, 2 ** 17)):
+            out_sort.out_sort(self.filename, self.output_filename, self.workdir, types="nsn",
+                              memory_usage=memory_usage, head=head)
+            with open(self.output_filename) as f:
+                self.assertEqual(expected[:head], f.readlines())
+            self.assertEqual([], os.listdir(self.workdir))
+        self.assertRaises(ValueError, out_sort.out_sort, self.filename, self.output_filename, self.workdir, head=-1)
+
+    def test_profile(self):
+        profile = os.path.join(self.path, "profile")
+        os.mkdir(profile)
+        with open(self.output_filename, "w") as f:
+            out_sort.sort_head(self.filename, f.name, 10 ** 4, self.workdir, False, self.parser, 2 ** 17,
+                               profile=profile)
+        # Workers of the pool the head of the sort needs dump their profiles once, when they exit.
+        names = sorted(os.listdir(profile))
+        self.assertEqual(["worker-{0}.prof".format(i) for i in range(os.cpu_count())], names)
+        self.assertGreater(sum(pstats.Stats(os.path.join(profile, name)).total_calls for name in names), 0)
+        with out_sort.WorkerPool(2, profile) as pool:
+            for name in names:
+                os.remove(os.path.join(profile, name))
+            out_sort.split_file_parallel(self.filename, False, self.parser, 10 ** 6, self.workdir, pool=pool)
+            self.assertEqual([], os.listdir(profile))
+        self.assertEqual(["worker-0.prof", "worker-1.prof"], sorted(os.listdir(profile)))
+
+    def test_resume(self):
+        merge_runs = out_sort._merge_runs
+
+        def interrupted(*args):
+            raise KeyboardInterrupt()
+
+        out_sort._merge_runs = interrupted
+        try:
+            self.assertRaises(KeyboardInterrupt, out_sort.out_sort, self.filename, self.output_filename,
+                              self.workdir, types="nsn", memory_usage=2 ** 19, resume=True)
+        finally:
+            out_sort._merge_runs = merge_runs
+        self.assertEqual([manifest.RUNS], os.listdir(self.workdir))
+        self.assertIn(manifest.MANIFEST, os.listdir(os.path.join(self.workdir, manifest.RUNS)))
+        split_input = out_sort._split_input
+        out_sort._split_input = interrupted
+        try:
+            out_sort.out_sort(self.filename, self.output_filename, self.workdir, types="nsn", memory_usage=2 ** 19,
+                              resume=True)
+        finally:
+            out_sort._split_input = split_input
+        self.check_output()
+        self.assertEqual([], os.listdir(self.workdir))
+        # Files of the user in the work directory survive a resumable sort, even ones named like runs.
+        for name in ("42", "m3", "7.idx"):
+            open(os.path.join(self.workdir, name), "w").close()
+        out_sort.out_sort(self.filename, self.output_filename, self.workdir, types="nsn", memory_usage=2 ** 19,
+                          resume=True)
+        self.check_output()
+        self.assertEqual(["42", "7.idx", "m3"], sorted(os.listdir(self.workdir)))
+
+    def test_external(self):
+        out_sort.out_sort(self.filename, self.output_filename, self.workdir, types="nsn", reverse_order=True,
+                          memory_usage=2 ** 19)
+        self.check_output(reverse_order=True)
+        self.assertEqual([], os.listdir(self.workdir))
+
+
+class GenerateCorpusTest(unittest.TestCase):
+    def test_corpus(self):
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, "input")
+            for types in ("nnssn", "s"):
+                count_of_lines = file_generator.generate_corpus(2 ** 20, filename, types, seed=1, duplicates=0.5,
+                                                                skew=2)
+                with open(filename, "rb") as f:
+                    data = f.read()
+                lines = data.splitlines()
+                self.assertEqual(count_of_lines, len(lines))
+                self.assertTrue(2 ** 20 <= len(data) < 2 ** 20 + len(lines[-1]) + 1)
+                self.assertLess(len(set(lines)), 0.6 * len(lines))
+                for line in lines[:100]:
+                    fields = line.split(b"    ")
+                    self.assertEqual(len(types), len(fields))
+                    for t, field in zip(types, fields):
+                        self.assertTrue(0 <= int(field) <= 100 if t == "n" else len(field) == 20)
+                file_generator.generate_corpus(2 ** 20, filename + "2", types, seed=1, duplicates=0.5, skew=2,
+                                               processes=2)
+                with open(filename + "2", "rb") as f:
+                    self.assertEqual(data, f.read())
+            with self.assertRaises(ValueError):
+                file_generator.generate_corpus(2 ** 10, filename, "x")
+
+
+class VerifierTest(unittest.TestCase):
+    def test_verify(self):
+        parser = key_spec.compile_parser(" ", 1, "n")
+        with tempfile.TemporaryDirectory() as path, out_sort.WorkerPool(2) as pool:
+            filename = os.path.join(path, "input")
+            numbers = [random.randint(0, 100) for _ in range(10000)]
+            with open(filename, "w") as f:
+                f.write("".join("{0} {1}\n".format(x, i) for i, x in enumerate(numbers)))
+            for reverse_order in (False, True):
+                output = os.path.join(path, "output")
+                out_sort.out_sort(filename, output, path, reverse_order, types="n", pool=pool)
+                # Small chunks make lines out of order fall on boundaries of chunks as well as inside them.
+                self.assertEqual(10000, verifier.verify(output, parser, reverse_order, filename, pool=pool,
+                                                        chunk_size=2 ** 10))
+                with self.assertRaises(ValueError):
+                    verifier.verify(output, parser, not reverse_order, pool=pool, chunk_size=2 ** 10)
+            with open(output, "rb") as f:
+                lines = f.read().splitlines(True)
+            for i in range(0, len(lines) - 1, 97):
+                changed = lines[:i] + [lines[i + 1], lines[i]] + lines[i + 2:]
+                with open(output, "wb") as f:
+                    f.write(b"".join(changed))
+                if parser(changed[i].decode())[0] != parser(changed[i + 1].decode())[0]:
+                    with self.assertRaisesRegex(ValueError, "Line {0} ".format(i + 2)):
+                        verifier.verify(output, parser, True, pool=pool, chunk_size=2 ** 10)
+            with open(output, "wb") as f:
+                f.write(b"".join(lines[:-1] + [lines[-1].replace(b" ", b"  ")]))
+            self.assertEqual(10000, verifier.verify(output, parser, True, pool=pool))
+            with self.assertRaises(ValueError):
+                verifier.verify(output, parser, True, filename, pool=pool)
+            self.assertEqual(verifier.checksum(filename, pool=pool, chunk_size=2 ** 10),
+                             verifier.checksum(filename, 1))
+            # Files of one chunk are checked without a pool.
+            self.assertEqual(verifier.checksum(filename, pool=pool), verifier.checksum(filename))
+            self.assertEqual(10000, file_generator.check_file(output, parser, True, pool=pool))
+
+    def test_main(self):
+        with self.assertRaises(SystemExit) as context:
+            verifier.main(verifier.read_args([os.path.join(tempfile.gettempdir(), "no such file")]))
+        self.assertEqual(2, context.exception.code)
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_run_and_compare(self):
+        with tempfile.TemporaryDirectory() as path:
+            old = benchmark.run([2 ** 16], ["ns"], [0.0, 0.5], [2 ** 12], [1], path=path)
+            self.assertEqual(2, len(old["results"]))
+            for result in old["results"]:
+                self.assertEqual(1, result["merges"])
+                self.assertEqual(1, result["passes"])
+                self.assertGreater(result["temp_written"], 2 ** 16)
+                self.assertGreater(result["peak_rss"], 0)
+            for result in benchmark.run([2 ** 16], ["ns"], [0.0], [2 ** 20], [1], path=path)["results"]:
+                self.assertEqual((0, 1, 0), (result["merges"], result["passes"], result["temp_written"]))
+            self.assertEqual([], os.listdir(path))
+        new = {"results": [dict(result, total_time=result["total_time"] * 2) for result in old["results"]]}
+        self.assertEqual([False, False], [change["regression"] for change in benchmark.compare(old, old)])
+        self.assertEqual([True, True], [change["regression"] for change in benchmark.compare(old, new)])
+        self.assertEqual(3 * 2 ** 19, benchmark.parse_size("1.5M"))
+
+
 class MergeFilesTest(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -186,6 +935,8 @@ class MergeFilesTest(unittest.TestCase):
         for i in range(40):
             cls.lines += file_generator.generate_file(2 ** 16, os.path.join(cls.path, str(i)))
             file_generator.generate_file(2 ** 16, os.path.join(cls.rev_path, str(i)))
+            make_run(os.path.join(cls.path, str(i)), cls.parser)
+            make_run(os.path.join(cls.rev_path, str(i)), cls.parser, True)
 
     @classmethod
     def tearDownClass(cls):
@@ -194,10 +945,99 @@ class MergeFilesTest(unittest.TestCase):
 
     def testSorted(self):
         filename = os.path.join(MergeFilesTest.path, "filename")
-        out_sort.merge_files("", filename, 40, 1000000, MergeFilesTest.parser, MergeFilesTest.path, False, None)
+        out_sort.merge_files("", filename, 40, 1000000, MergeFilesTest.path, False, None)
         self.assertEqual(MergeFilesTest.lines, file_generator.check_file(filename, MergeFilesTest.parser, False))
 
     def testReversed(self):
         filename = os.path.join(MergeFilesTest.rev_path, "filename")
-        out_sort.merge_files("", filename, 40, 1000000, MergeFilesTest.parser, MergeFilesTest.rev_path, True, None)
+        out_sort.merge_files("", filename, 40, 1000000, MergeFilesTest.rev_path, True, None)
         self.assertEqual(MergeFilesTest.lines, file_generator.check_file(filename, MergeFilesTest.parser, True))
+
+    def testSeveralPasses(self):
+        with tempfile.TemporaryDirectory() as path:
+            lines = 0
+            for i in range(40):
+                current = os.path.join(path, str(i))
+                lines += file_generator.generate_random_file(2 ** 12, current)
+                make_run(current, MergeFilesTest.parser)
+            filename = os.path.join(path, "filename")
+            out_sort.merge_files("", filename, 40, 2 ** 14, path, False, None)
+            self.assertEqual(lines, file_generator.check_file(filename, MergeFilesTest.parser, False))
+            self.assertEqual(["filename"], os.listdir(path))
+
+    def testPipelined(self):
+        with tempfile.TemporaryDirectory() as path, out_sort.WorkerPool(2) as pool:
+            scheduler = out_sort._MergeScheduler(pool, path, 2 ** 14, False)
+            lines = 0
+            for i in range(40):
+                current = os.path.join(path, str(i))
+                lines += file_generator.generate_random_file(2 ** 12, current)
+                make_run(current, MergeFilesTest.parser)
+                scheduler.add_run(current)
+            self.assertGreater(scheduler.count_of_merges, 0)
+            filename = os.path.join(path, "filename")
+            out_sort._merge_runs("", filename, scheduler, None)
+            self.assertEqual(lines, file_generator.check_file(filename, MergeFilesTest.parser, False))
+            self.assertEqual(["filename"], os.listdir(path))
+
+    def testPartitioned(self):
+        with tempfile.TemporaryDirectory() as path, out_sort.WorkerPool(3) as pool:
+            filename = os.path.join(path, "input")
+            lines = file_generator.generate_random_file(2 ** 20, filename)
+            for reverse_order in (False, True):
+                workdir = tempfile.mkdtemp(dir=path)
+                count_of_files = out_sort.split_file_parallel(filename, reverse_order, MergeFilesTest.parser,
+                                                              10 ** 6, workdir, pool=pool, indexed=True)
+                files = [os.path.join(workdir, str(i)) for i in range(count_of_files)]
+                scheduler = out_sort._MergeScheduler(pool, workdir, 2 ** 20, reverse_order)
+                self.assertEqual(3, len(out_sort._partition_final_merge(filename + ".sorted", files, scheduler)))
+                out_sort.merge_files(filename, filename + ".sorted", count_of_files, 2 ** 20, workdir,
+                                     reverse_order, None, pool=pool)
+                self.assertEqual(lines, file_generator.check_file(filename + ".sorted", MergeFilesTest.parser,
+                                                                  reverse_order, pool))
+                self.assertEqual(os.path.getsize(filename), os.path.getsize(filename + ".sorted"))
+                self.assertEqual([], os.listdir(workdir))
+            # Outputs which are not regular files are merged serially.
+            workdir = tempfile.mkdtemp(dir=path)
+            count_of_files = out_sort.split_file_parallel(filename, False, MergeFilesTest.parser, 10 ** 6, workdir,
+                                                          pool=pool)
+            files = [os.path.join(workdir, str(i)) for i in range(count_of_files)]
+            scheduler = out_sort._MergeScheduler(pool, workdir, 2 ** 20, False)
+            self.assertIsNone(out_sort._partition_final_merge(os.devnull, files, scheduler))
+            out_sort.merge_files(filename, os.devnull, count_of_files, 2 ** 20, workdir, False, None, pool=pool)
+            self.assertEqual([], os.listdir(workdir))
+
+    def testIndexed(self):
+        # Runs get indexes only for a final merge which can be partitioned.
+        self.assertTrue(out_sort._can_partition("output", 2, None, None))
+        self.assertFalse(out_sort._can_partition("output", 1, None, None))
+        self.assertFalse(out_sort._can_partition("output", 2, "zlib", None))
+        self.assertFalse(out_sort._can_partition("output", 2, None, "unique"))
+        self.assertFalse(out_sort._can_partition("output", 2, None, None, 10))
+        self.assertFalse(out_sort._can_partition(out_sort.STREAM, 2, None, None))
+        self.assertFalse(out_sort._can_partition(os.devnull, 2, None, None))
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, "input")
+            file_generator.generate_random_file(2 ** 18, filename)
+            for indexed in (False, True):
+                workdir = tempfile.mkdtemp(dir=path)
+                out_sort.split_file_mmap(filename, False, MergeFilesTest.parser, 2 ** 16, workdir, indexed=indexed)
+                self.assertEqual(indexed, os.path.exists(os.path.join(workdir, "0.idx")))
+                workdir = tempfile.mkdtemp(dir=path)
+                out_sort.replacement_selection(filename, False, MergeFilesTest.parser, 2 ** 16, workdir,
+                                               indexed=indexed)
+                self.assertEqual(indexed, os.path.exists(os.path.join(workdir, "0.idx")))
+
+    def testStatistic(self):
+        with tempfile.TemporaryDirectory() as path:
+            for i in range(10):
+                file_generator.generate_file(2 ** 12, os.path.join(path, str(i)))
+                make_run(os.path.join(path, str(i)), MergeFilesTest.parser)
+            filename = os.path.join(path, "filename")
+            printed = []
+            stat = Statistic(lambda current: printed.append(current.printed_size))
+            stat.next_state(0)
+            out_sort.merge_files("", filename, 10, 2 ** 20, path, False, stat)
+            self.assertEqual(State.MERGING, stat.state)
+            self.assertEqual(os.path.getsize(filename), stat.printed_size)
+            self.assertEqual(sorted(printed), printed)
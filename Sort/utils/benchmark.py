@@ -0,0 +1,198 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from out_sort import out_sort
+from out_sort.sort_statistic import State, Statistic
+from utils import file_generator
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_UNITS = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30}
+# Results are matched by these fields when two benchmark files are compared.
+_CASE = ("size", "types", "duplicates", "memory_usage", "processes")
+_TIMES = ("split_time", "merge_time", "total_time")
+
+
+class _Timer:
+    # Statistic printer remembering when every state of the sort began.
+    def __init__(self):
+        self.times = {}
+
+    def __call__(self, stat):
+        self.times.setdefault(stat.state, time.perf_counter())
+
+
+def parse_size(value):
+    value = value.strip().upper()
+    if value and value[-1] in _UNITS:
+        return int(float(value[:-1]) * _UNITS[value[-1]])
+    return int(value)
+
+
+def _get_peak_rss():
+    # Peak RSS in bytes of the sorting process and of its largest worker, None where it can not be measured.
+    if resource is None:
+        return None
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+
+
+def _sort(filename, memory_usage, processes, types, connection):
+    timer = _Timer()
+    statistic = Statistic(timer)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(filename)) as path:
+        start = time.perf_counter()
+        out_sort.out_sort(filename, filename + ".sorted", path, types=types, memory_usage=memory_usage,
+                          statistic=statistic, processes=processes)
+        finish = time.perf_counter()
+    output_size = os.path.getsize(filename + ".sorted")
+    os.remove(filename + ".sorted")
+    merge_start = timer.times.get(State.MERGING, finish)
+    report = statistic.report()
+    totals = {}
+    for phase in report["phases"].values():
+        for values in phase["workers"].values():
+            for metric in ("merges", "written_bytes", "merge_written_bytes"):
+                totals[metric] = totals.get(metric, 0) + values[metric]
+    runs_written = totals.get("written_bytes", 0)
+    # The final merge writes the output, which is not a temporary file.
+    merges_written = totals.get("merge_written_bytes", 0) - output_size if totals.get("merges") else 0
+    connection.send({
+        "split_time": merge_start - start,
+        "merge_time": finish - merge_start,
+        "total_time": finish - start,
+        # Passes over the data: bytes read by all merges per byte of the runs, one for a sort in memory.
+        "passes": report["merge_passes"] if runs_written else 1,
+        # Merges of runs including the final one.
+        "merges": totals.get("merges", 0),
+        "temp_written": runs_written + merges_written,
+        "peak_rss": _get_peak_rss(),
+    })
+    connection.close()
+
+
+def measure(filename, memory_usage, processes=1, types=""):
+    # Every sort runs in a process of its own, so peak RSS is not carried over between cases.
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_sort, args=(filename, memory_usage, processes, types, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        raise RuntimeError("Sorting of {0} failed.".format(filename))
+    finally:
+        process.join()
+    return result
+
+
+def run(sizes, types_list, duplicates_list, memory_usages, processes_list, path=None, seed=0, repeat=1):
+    results = []
+    with tempfile.TemporaryDirectory(dir=path) as tempdir:
+        for size in sizes:
+            for types in types_list:
+                for duplicates in duplicates_list:
+                    filename = os.path.join(tempdir, "input")
+                    file_generator.generate_corpus(size, filename, types, seed, duplicates)
+                    for memory_usage in memory_usages:
+                        for processes in processes_list:
+                            # The fastest of the repeats is the least disturbed by the rest of the system.
+                            result = min((measure(filename, memory_usage, processes, types) for _ in range(repeat)),
+                                         key=lambda current: current["total_time"])
+                            result.update(size=size, types=types, duplicates=duplicates,
+                                          memory_usage=memory_usage, processes=processes)
+                            results.append(result)
+                    os.remove(filename)
+    return {
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpu_count": os.cpu_count()},
+        "results": results,
+    }
+
+
+def compare(old, new, threshold=0.1):
+    # Relative change of the times of every case present in both results; a regression is a slowdown above threshold.
+    old_results = {tuple(result[field] for field in _CASE): result for result in old["results"]}
+    changes = []
+    for result in new["results"]:
+        case = tuple(result[field] for field in _CASE)
+        if case not in old_results:
+            continue
+        change = {field: value for field, value in zip(_CASE, case)}
+        for field in _TIMES:
+            before = old_results[case][field]
+            change[field] = (result[field] - before) / before if before else 0.0
+        change["regression"] = change["total_time"] > threshold
+        changes.append(change)
+    return changes
+
+
+def _print_changes(changes, file=sys.stdout):
+    for change in changes:
+        print("{size:>12} {types:>8} {duplicates:>5} {memory_usage:>12} {processes:>3}  "
+              "split {split_time:+7.1%}  merge {merge_time:+7.1%}  total {total_time:+7.1%}{0}"
+              .format("  REGRESSION" if change["regression"] else "", **change), file=file)
+
+
+def read_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks of out_sort.")
+    commands = parser.add_subparsers(dest="command")
+    run_parser = commands.add_parser("run", help="Generate datasets, sort them and write results as JSON.")
+    run_parser.add_argument("output", type=str, help="File for results.")
+    run_parser.add_argument("--sizes", type=str, default="5M,20M,100M",
+                            help="Comma separated sizes of datasets, e.g. 5M,1G.")
+    run_parser.add_argument("--types", type=str, default="nnssn",
+                            help="Comma separated types of columns of datasets.")
+    run_parser.add_argument("--duplicates", type=str, default="0",
+                            help="Comma separated shares of duplicate lines.")
+    run_parser.add_argument("--memory", type=str, default="1M,8M,64M",
+                            help="Comma separated memory usages.")
+    run_parser.add_argument("-p", type=str, default="1", dest="processes",
+                            help="Comma separated counts of processes.")
+    run_parser.add_argument("--dir", type=str, default=None, dest="path",
+                            help="Directory for datasets and temporary files.")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--repeat", type=int, default=1, help="Runs of every case; the fastest is kept.")
+    compare_parser = commands.add_parser("compare", help="Compare two results and report regressions.")
+    compare_parser.add_argument("old", type=str)
+    compare_parser.add_argument("new", type=str)
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="Slowdown of total time reported as a regression.")
+    result = parser.parse_args(argv)
+    if result.command is None:
+        parser.error("Command is required.")
+    return result
+
+
+def main(argv):
+    if argv.command == "compare":
+        with open(argv.old) as f:
+            old = json.load(f)
+        with open(argv.new) as f:
+            new = json.load(f)
+        changes = compare(old, new, argv.threshold)
+        _print_changes(changes)
+        if any(change["regression"] for change in changes):
+            sys.exit(1)
+        return
+    results = run([parse_size(x) for x in argv.sizes.split(",")],
+                  argv.types.split(","),
+                  [float(x) for x in argv.duplicates.split(",")],
+                  [parse_size(x) for x in argv.memory.split(",")],
+                  [int(x) for x in argv.processes.split(",")],
+                  path=argv.path, seed=argv.seed, repeat=argv.repeat)
+    with open(argv.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(read_args(sys.argv[1:]))
@@ -1,5 +1,29 @@
+import argparse
+import itertools
+import os
+import random
+import sys
+from functools import lru_cache
+from multiprocessing import Pool
 from random import randint
 
+from out_sort import out_sort
+from utils import verifier
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_SEPARATOR = b"    "
+_STRING_LENGTH = 20
+_FIRST_CHAR = 33
+_COUNT_OF_CHARS = 91
+# Random bytes are spread over the 91 printable characters used by generate_random_string.
+_PRINTABLE = bytes(_FIRST_CHAR + b * _COUNT_OF_CHARS // 256 for b in range(256))
+_BLOCK_LINES = 2 ** 15
+_POOL_LINES = 2 ** 10
+
 
 def generate_random_string(length):
     answer = ""
@@ -35,27 +59,155 @@ def generate_file(size, filename, types="s"):
     return count_of_lines
 
 
-def check_file(filename, parser, reverse_order):
-    prev_line = None
-    count_of_line = 0
-    with open(filename, "r") as file:
-        for line in file:
-            if line:
-                count_of_line += 1
-            if prev_line and line:
-                parsed_line = parser(line)
-                parsed_prev = parser(prev_line)
-                if parsed_prev != parsed_line and (parsed_prev < parsed_line) == reverse_order:
-                    return 0
-            prev_line = line
-    return count_of_line
+def check_file(filename, parser, reverse_order, pool=None):
+    # Count of lines of a sorted file, 0 if it is not sorted.
+    try:
+        return verifier.verify(filename, parser, reverse_order, pool=pool)
+    except ValueError:
+        return 0
+
+
+def _block_random(seed, block):
+    # Blocks are seeded by their number, so the output does not depend on the count of processes.
+    if np is not None:
+        return np.random.default_rng([seed, block])
+    return random.Random("%d:%d" % (seed, block))
+
+
+def _numbers(rng, count, max_number, skew):
+    # Skew above 1 crowds numbers towards 0, 1 keeps them uniform.
+    if np is not None:
+        return (rng.random(count) ** skew * (max_number + 1)).astype(np.int64)
+    return [int(rng.random() ** skew * (max_number + 1)) for _ in range(count)]
+
+
+def _numpy_lines(rng, types, count, max_number, skew):
+    # Lines are built as a byte matrix with a mask of the bytes kept, so numbers can be shorter than the column.
+    width = len(str(max_number))
+    powers = 10 ** np.arange(width - 1, -1, -1)
+    columns = []
+    masks = []
+    for i, t in enumerate(types):
+        if i:
+            columns.append(np.frombuffer(_SEPARATOR * count, dtype=np.uint8).reshape(count, -1))
+        if t == "n":
+            values = _numbers(rng, count, max_number, skew)
+            columns.append((values[:, None] // powers % 10 + ord("0")).astype(np.uint8))
+            lengths = 1 + (values[:, None] >= powers[:-1]).sum(axis=1)
+            masks.append((i, np.arange(width) >= width - lengths[:, None]))
+        else:
+            columns.append(rng.integers(_FIRST_CHAR, _FIRST_CHAR + _COUNT_OF_CHARS, (count, _STRING_LENGTH),
+                                        dtype=np.uint8))
+    columns.append(np.full((count, 1), ord("\n"), dtype=np.uint8))
+    mask = [np.ones(column.shape, dtype=bool) for column in columns]
+    for i, column_mask in masks:
+        mask[2 * i] = column_mask
+    return np.hstack(columns), np.hstack(mask)
+
+
+def _python_lines(rng, types, count, max_number, skew):
+    lines = []
+    for _ in range(count):
+        fields = []
+        for t in types:
+            if t == "n":
+                fields.append(str(_numbers(rng, 1, max_number, skew)[0]).encode())
+            else:
+                fields.append(rng.getrandbits(8 * _STRING_LENGTH).to_bytes(_STRING_LENGTH, "little")
+                              .translate(_PRINTABLE))
+        lines.append(_SEPARATOR.join(fields) + b"\n")
+    return lines
+
+
+@lru_cache(maxsize=None)
+def _pool(types, seed, max_number, skew):
+    # Duplicates of all blocks are drawn from one pool of lines, block 0 of the seed.
+    rng = _block_random(seed, 0)
+    if np is not None:
+        return _numpy_lines(rng, types, _POOL_LINES, max_number, skew)
+    return _python_lines(rng, types, _POOL_LINES, max_number, skew)
+
+
+def _generate_block(args):
+    types, seed, block, duplicates, max_number, skew = args
+    rng = _block_random(seed, block + 1)
+    if np is not None:
+        lines, mask = _numpy_lines(rng, types, _BLOCK_LINES, max_number, skew)
+        if duplicates:
+            copied = rng.random(_BLOCK_LINES) < duplicates
+            pool_lines, pool_mask = _pool(types, seed, max_number, skew)
+            chosen = rng.integers(0, _POOL_LINES, int(copied.sum()))
+            lines[copied] = pool_lines[chosen]
+            mask[copied] = pool_mask[chosen]
+        return lines[mask].tobytes()
+    lines = _python_lines(rng, types, _BLOCK_LINES, max_number, skew)
+    if duplicates:
+        pool = _pool(types, seed, max_number, skew)
+        for i in range(_BLOCK_LINES):
+            if rng.random() < duplicates:
+                lines[i] = rng.choice(pool)
+    return b"".join(lines)
+
+
+def generate_corpus(size, filename, types="s", seed=0, duplicates=0.0, skew=1.0, max_number=100, processes=1):
+    # Lines like generate_random_file makes, built in blocks with numpy when it is installed.
+    # A share of duplicates of the lines is copied from a pool of lines common to the whole file.
+    if not types or set(types) - {"n", "s"}:
+        raise ValueError("Types must consist of 'n' and 's'")
+    if not 0 <= duplicates <= 1:
+        raise ValueError("Duplicates must be between 0 and 1")
+    if skew < 1:
+        raise ValueError("Skew must be at least 1")
+    if max_number < 0:
+        raise ValueError("Max number must be non-negative")
+    first = _generate_block((types, seed, 0, duplicates, max_number, skew))
+    estimate = max((size + len(first) - 1) // len(first), 1)
+    tasks = [(types, seed, block, duplicates, max_number, skew) for block in range(1, estimate)]
+    pool = Pool(processes) if processes > 1 and tasks else None
+    try:
+        if pool:
+            # Blocks come in order; at most two blocks per process are generated ahead of the writer.
+            blocks = out_sort.bounded_map(pool, _generate_block, ((task,) for task in tasks), 2 * processes)
+        else:
+            blocks = map(_generate_block, tasks)
+        blocks = itertools.chain([first], blocks)
+        written = 0
+        count_of_lines = 0
+        with open(filename, "wb", buffering=0) as f:
+            for block in itertools.chain(blocks, (_generate_block((types, seed, block, duplicates, max_number, skew))
+                                                  for block in itertools.count(estimate))):
+                # The last block is cut after the line reaching size; blocks beyond the estimate are rarely needed.
+                if written + len(block) >= size:
+                    block = block[:block.index(b"\n", max(size - written, 1) - 1) + 1]
+                f.write(block)
+                written += len(block)
+                count_of_lines += block.count(b"\n")
+                if written >= size:
+                    break
+    finally:
+        if pool:
+            pool.terminate()
+    return count_of_lines
+
+
+def read_args(argv):
+    parser = argparse.ArgumentParser(description="Generator of random files.")
+    parser.add_argument("filename", type=str)
+    parser.add_argument("size", type=int, help="Size of the file in bytes.")
+    parser.add_argument("-t", type=str, default="nnssn", dest="types",
+                        help="Types of columns: n - number, s - string.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--duplicates", type=float, default=0.0, help="Share of duplicate lines.")
+    parser.add_argument("--skew", type=float, default=1.0, help="Skew of numbers towards 0, 1 is uniform.")
+    parser.add_argument("--max-number", type=int, default=100, dest="max_number")
+    parser.add_argument("-p", type=int, default=os.cpu_count(), dest="processes", help="Count of processes.")
+    return parser.parse_args(argv)
 
 
-def main():
-    size = 5 * 2 ** 20
-    for i in range(size, 21 * size, size):
-        generate_random_file(i, str(i), "nnssn")
+def main(argv):
+    generate_corpus(argv.size, argv.filename, argv.types, argv.seed, argv.duplicates, argv.skew, argv.max_number,
+                    argv.processes)
 
 
 if __name__ == '__main__':
-    main()
+    main(read_args(sys.argv[1:]))
@@ -0,0 +1,138 @@
+import argparse
+import os
+import sys
+from contextlib import contextmanager
+from hashlib import blake2b
+
+from out_sort import key_spec, out_sort
+
+_CHUNK_SIZE = 2 ** 24
+_HASH_SIZE = 16
+_HASH_MODULUS = 2 ** (8 * _HASH_SIZE)
+
+
+def _read_lines(filename, offset, length):
+    # Empty lines are skipped as out_sort skips them.
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        return [line for line in f.read(length).split(b"\n") if line]
+
+
+def _hash_lines(lines):
+    # Sum of hashes of the lines, the same for any order of them.
+    return sum(int.from_bytes(blake2b(line, digest_size=_HASH_SIZE).digest(), "little")
+               for line in lines) % _HASH_MODULUS
+
+
+def _is_out_of_order(prev_key, key, reverse_order):
+    return key > prev_key if reverse_order else key < prev_key
+
+
+def _check_chunk(filename, offset, length, parser, reverse_order, encoding, with_hash):
+    # Every line is parsed once; the first and the last keys let the boundaries of chunks be checked.
+    if isinstance(parser, bytes):
+        parser = out_sort.load_parser(parser)
+    # Parsed fields compare in the same order as the keys out_sort encodes from them.
+    lines = _read_lines(filename, offset, length)
+    line_keys = [parser(line.decode(encoding))[0] for line in lines]
+    unsorted = next((i for i in range(1, len(line_keys))
+                     if _is_out_of_order(line_keys[i - 1], line_keys[i], reverse_order)), None)
+    if not line_keys:
+        return 0, None, None, None, 0
+    return len(lines), line_keys[0], line_keys[-1], unsorted, _hash_lines(lines) if with_hash else 0
+
+
+def _hash_chunk(filename, offset, length):
+    lines = _read_lines(filename, offset, length)
+    return len(lines), _hash_lines(lines)
+
+
+@contextmanager
+def _use_pool(filename, chunk_size, pool, processes):
+    # A file of one chunk is checked in this process unless a pool is given.
+    if pool is None and os.path.getsize(filename) <= chunk_size:
+        yield None
+        return
+    with out_sort.use_pool(pool, processes) as pool:
+        yield pool
+
+
+def _map_chunks(pool, func, filename, chunk_size, *args):
+    # Results come in the order of chunks; at most two chunks per process are read at once.
+    tasks = ((filename, offset, length) + args for offset, length in out_sort.get_blocks(filename, chunk_size))
+    if pool is None:
+        return (func(*task) for task in tasks)
+    return out_sort.bounded_map(pool, func, tasks, 2 * pool.processes)
+
+
+def checksum(filename, processes=None, pool=None, chunk_size=_CHUNK_SIZE):
+    # Count of lines and their hash independent of the order of lines.
+    count_of_lines = 0
+    digest = 0
+    with _use_pool(filename, chunk_size, pool, processes) as pool:
+        for count, chunk_digest in _map_chunks(pool, _hash_chunk, filename, chunk_size):
+            count_of_lines += count
+            digest = (digest + chunk_digest) % _HASH_MODULUS
+    return count_of_lines, digest
+
+
+def verify(filename, parser, reverse_order=False, input_filename=None, processes=None, pool=None,
+           chunk_size=_CHUNK_SIZE, encoding="utf-8"):
+    # Count of lines of the sorted file. ValueError is raised at the first line out of order
+    # and, if the input file is given, when lines of the files differ as multisets.
+    parser = out_sort.dump_parser(parser)
+    count_of_lines = 0
+    digest = 0
+    last_key = None
+    with _use_pool(filename, chunk_size, pool, processes) as pool:
+        for count, first_key, chunk_last_key, unsorted, chunk_digest in _map_chunks(
+                pool, _check_chunk, filename, chunk_size, parser, reverse_order, encoding,
+                input_filename is not None):
+            if unsorted is not None:
+                raise ValueError("Line {0} is out of order.".format(count_of_lines + unsorted + 1))
+            if count and last_key is not None and _is_out_of_order(last_key, first_key, reverse_order):
+                raise ValueError("Line {0} is out of order.".format(count_of_lines + 1))
+            if count:
+                last_key = chunk_last_key
+            count_of_lines += count
+            digest = (digest + chunk_digest) % _HASH_MODULUS
+        if input_filename is not None and checksum(input_filename, pool=pool, chunk_size=chunk_size) != \
+                (count_of_lines, digest):
+            raise ValueError("Lines of {0} differ from lines of {1}.".format(filename, input_filename))
+    return count_of_lines
+
+
+def read_args(argv):
+    parser = argparse.ArgumentParser(description="Verifier of files sorted by out_sort.")
+    parser.add_argument("filename", type=str, help="Sorted file.")
+    parser.add_argument("-i", type=str, default=None, dest="input_filename",
+                        help="Input of the sort; its lines are compared with lines of the sorted file.")
+    parser.add_argument("-r", action="store_true", default=False, dest="reverse_order")
+    parser.add_argument("-s", type=str, default=" ", dest="sep")
+    parser.add_argument("-f", type=int, default=1, dest="field")
+    parser.add_argument("--types", type=str, default="", dest="types")
+    parser.add_argument("-k", action="append", type=str, dest="key_specs", default=None)
+    parser.add_argument("-e", type=str, default="utf-8", dest="encoding")
+    parser.add_argument("-p", type=int, default=None, dest="processes", help="Count of processes.")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    if argv.key_specs:
+        parser = key_spec.compile_keys(argv.key_specs, argv.sep)
+    else:
+        parser = key_spec.compile_parser(argv.sep, argv.field, argv.types)
+    try:
+        count_of_lines = verify(argv.filename, parser, argv.reverse_order, argv.input_filename, argv.processes,
+                                encoding=argv.encoding)
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    except OSError as err:
+        print(err, file=sys.stderr)
+        sys.exit(2)
+    print("Sorted, {0} lines.".format(count_of_lines))
+
+
+if __name__ == "__main__":
+    main(read_args(sys.argv[1:]))